@@ -0,0 +1,163 @@
+import pandas
+import numpy as np
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+from typing import Dict, List, TypedDict
+from utils import Utils, Shards, apply_schema, address_schema
+from process_data import process_addresses
+from match_addresses import AddressIndex, MatchInputs, get_borders_context, get_streets_teryt, get_district_tokens_to_skip, parse_borders, select_addresses, read_rules, get_rule_index
+
+pandas.options.mode.copy_on_write = True
+
+corpus_path = "benchmark/districts.csv"
+vocabulary_path = "benchmark/streets.csv"
+baseline_path = "benchmark/baseline.json"
+stages = ["tokenizing", "street_recognition", "address_selection"]
+default_repeat = 5
+default_threshold = 0.2
+
+class BenchmarkResult(TypedDict):
+  stages: Dict[str, float]
+  districts: int
+  districts_per_second: float
+  matched_addresses: int
+
+class TimedUtils(Utils):
+  def __init__(self):
+    # Street name cache is disabled, otherwise only the first run would measure street recognition
+    super().__init__()
+    self.street_time = 0.0
+
+  def transform_street_name(self, street: str, teryt: str):
+    start = time.perf_counter()
+    result = super().transform_street_name(street, teryt)
+    self.street_time += time.perf_counter() - start
+    return result
+
+def load_vocabulary(utils: Utils):
+  streets = pandas.read_csv(vocabulary_path, converters={ "teryt": str }, sep=";", encoding="utf-8")
+  rows = []
+  for street in streets.itertuples():
+    for number in range(1, street.buildings + 1):
+      rows.append((street.teryt, street.town, street.street, street.str_type, str(number)))
+      # Some buildings have letters, these are the hardest to match with ranges
+      if (number % 7 == 0):
+        rows.append((street.teryt, street.town, street.street, street.str_type, f"{number}a"))
+
+  addresses = pandas.DataFrame(rows, columns=["teryt", "town", "street", "str_type", "building"])
+  with contextlib.redirect_stdout(io.StringIO()):
+    addresses = process_addresses(addresses, {}, utils)
+  addresses["address_id"] = np.arange(len(addresses), dtype=np.int64)
+  return apply_schema(addresses, address_schema)
+
+def load_corpus() -> MatchInputs:
+  return {
+    "districts": Shards(pandas.read_csv(corpus_path, converters={ "teryt": str }, sep="|", encoding="utf-8")),
+    "towns": Shards(pandas.DataFrame({ "teryt": [], "town": [] })),
+    "rules": get_rule_index(read_rules("const/tokens_to_skip.csv"), read_rules("const/tokens_to_replace.csv")),
+    "extra_streets": Shards(read_rules("const/extra_streets.csv")),
+    "addresses_to_skip": Shards(read_rules("const/addresses_to_skip.csv")),
+  }
+
+def run_benchmark(inputs: MatchInputs, addresses: pandas.DataFrame, utils: TimedUtils) -> BenchmarkResult:
+  times = { stage: 0.0 for stage in stages }
+  districts = inputs["districts"]
+  address_shards = Shards(addresses)
+  matched_addresses = 0
+  for teryt in sorted(districts.keys()):
+    teryt_addresses = address_shards.get(teryt)
+    context = get_borders_context(teryt, teryt_addresses, address_shards.get(get_streets_teryt(teryt)), inputs)
+    address_index = AddressIndex(teryt_addresses)
+    for i, district in districts.get(teryt).iterrows():
+      district_tokens_to_skip = get_district_tokens_to_skip(inputs["rules"], teryt, district.number)
+      utils.street_time = 0.0
+      start = time.perf_counter()
+      parsed_tokens = parse_borders(context, district, district_tokens_to_skip, utils)
+      parse_time = time.perf_counter() - start
+      times["street_recognition"] += utils.street_time
+      times["tokenizing"] += parse_time - utils.street_time
+
+      start = time.perf_counter()
+      district_address_ids: set[int] = set()
+      for token in parsed_tokens:
+        district_address_ids.update(select_addresses(address_index, token, district_address_ids))
+      times["address_selection"] += time.perf_counter() - start
+      matched_addresses += len(district_address_ids)
+
+  return {
+    "stages": times,
+    "districts": len(districts),
+    "districts_per_second": len(districts) / sum(times.values()),
+    "matched_addresses": matched_addresses,
+  }
+
+def get_best_result(results: List[BenchmarkResult]) -> BenchmarkResult:
+  # The fastest run is the least affected by noise from other processes
+  best_stages = { stage: min([result["stages"][stage] for result in results]) for stage in stages }
+  districts = results[0]["districts"]
+  return {
+    "stages": best_stages,
+    "districts": districts,
+    "districts_per_second": districts / sum(best_stages.values()),
+    "matched_addresses": results[0]["matched_addresses"],
+  }
+
+def print_result(result: BenchmarkResult, baseline: BenchmarkResult | None, threshold: float):
+  regressions: List[str] = []
+  print(f"{"Stage":<20}{"Time (ms)":>12}{"Baseline (ms)":>16}{"Change":>10}")
+  for stage in [*stages, "total"]:
+    value = sum(result["stages"].values()) if stage == "total" else result["stages"][stage]
+    if (baseline is None):
+      print(f"{stage:<20}{value * 1000:>12.1f}")
+      continue
+    baseline_value = sum(baseline["stages"].values()) if stage == "total" else baseline["stages"][stage]
+    change = (value - baseline_value) / baseline_value if baseline_value > 0 else 0
+    is_regression = change > threshold
+    if (is_regression):
+      regressions.append(stage)
+    print(f"{stage:<20}{value * 1000:>12.1f}{baseline_value * 1000:>16.1f}{change * 100:>+9.1f}%{" ⚠️" if is_regression else ""}")
+
+  print(f"Throughput: {result["districts_per_second"]:.1f} districts/second ({result["districts"]} districts).")
+  print(f"Matched addresses: {result["matched_addresses"]}.")
+  if (baseline is not None and baseline["matched_addresses"] != result["matched_addresses"]):
+    print(f"⚠️ Number of matched addresses changed from {baseline["matched_addresses"]}, results have to be checked!")
+  return regressions
+
+def main(repeat: int = default_repeat, threshold: float = default_threshold, save_baseline: bool = False):
+  print("Loading benchmark data...")
+  utils = TimedUtils()
+  addresses = load_vocabulary(utils)
+  inputs = load_corpus()
+  print(f"Running benchmark {repeat} times for {len(inputs["districts"])} districts and {len(addresses)} addresses...")
+  results: List[BenchmarkResult] = []
+  for i in range(repeat):
+    with contextlib.redirect_stdout(io.StringIO()):
+      results.append(run_benchmark(inputs, addresses, utils))
+  result = get_best_result(results)
+
+  baseline: BenchmarkResult | None = None
+  if (os.path.isfile(baseline_path) and not save_baseline):
+    with open(baseline_path, encoding="utf-8") as file:
+      baseline = json.load(file)
+  regressions = print_result(result, baseline, threshold)
+
+  if (save_baseline):
+    with open(baseline_path, "w", encoding="utf-8") as file:
+      json.dump(result, file, indent=2)
+    print(f"Saved baseline to {baseline_path}!")
+  if (len(regressions) > 0):
+    print(f"Stages slower by more than {threshold * 100:.0f}%: {", ".join(regressions)}.")
+    sys.exit(1)
+
+if (__name__ == "__main__"):
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--repeat", type=int, default=default_repeat, help="Number of benchmark runs, the fastest one is reported")
+  parser.add_argument("--threshold", type=float, default=default_threshold, help="Relative slowdown reported as a regression")
+  parser.add_argument("--save-baseline", action="store_true", help="Save results as the new baseline")
+  args = parser.parse_args()
+  main(args.repeat, args.threshold, args.save_baseline)
@@ -1,6 +1,6 @@
 import geopandas as geo
 import pandas as pd
-from utils import concat
+from utils import concat, load_parquet, OutputWriter, save_geojson, apply_schema, matched_address_schema
 from const import results_columns, candidates
 import uuid
 import os
@@ -69,7 +69,7 @@ def process_teryt(teryt: str, addresses: geo.GeoDataFrame, districts_df: geo.Geo
     districts_df.loc[touching.name, "geometry"] = touching.geometry.union(row.geometry)
 
   districts_df.geometry = districts_df.geometry.buffer(1, cap_style="flat", join_style="bevel")
-  districts_df = districts_df.dissolve(by="district")
+  districts_df = districts_df.dissolve(by="district", observed=True)
   districts_df.geometry = districts_df.geometry.make_valid(method="structure")
   return districts_df
 
@@ -81,10 +81,12 @@ def main():
   addresses_to_skip = pd.read_csv("const/addresses_to_skip.csv", sep=";", converters={ "teryt": str })
   districts["TERYT"] = districts["TERYT"].str[:-1]
   districts["OBWOD"] = districts["OBWOD"].apply(lambda x: str(uuid.uuid4()))
-  file_names = list(sorted(filter(lambda x: x.endswith(".zip"), os.listdir("matched_addresses"))))
+  file_names = list(sorted(filter(lambda x: x.endswith(".parquet"), os.listdir("matched_addresses"))))
 
   for file_name in file_names:
-    addresses = geo.read_file(f"matched_addresses/{file_name}")
+    addresses = load_parquet(f"matched_addresses/{path.splitext(file_name)[0]}", columns=["teryt", "f_address", "district", "geometry"])
+    # District stays a string, categories from other gminas would end up as empty districts after dissolve
+    addresses = apply_schema(addresses, matched_address_schema, ["teryt"])
     teryts = addresses["teryt"].drop_duplicates()
     for teryt in teryts:
       teryt_addresses_to_skip = addresses_to_skip[addresses_to_skip["teryt"] == teryt]["f_address"].to_list()
@@ -136,10 +138,11 @@ def main():
   if (not path.exists(districts_path)):
     os.mkdir(districts_path)
 
-  for i in range(16):
-    woj_teryt = str((i + 1) * 2).rjust(2, "0")
-    woj_districts = districts_df[districts_df["teryt"].str.startswith(woj_teryt)]
-    woj_districts.to_file(f"{districts_path}/{woj_teryt}.json", driver="GeoJSON")
+  with OutputWriter() as writer:
+    for i in range(16):
+      woj_teryt = str((i + 1) * 2).rjust(2, "0")
+      woj_districts = districts_df[districts_df["teryt"].str.startswith(woj_teryt)]
+      writer.submit(f"districts for voivodeship {woj_teryt}", save_geojson, f"{districts_path}/{woj_teryt}.json", woj_districts)
 
 if (__name__ == "__main__"):
   main()
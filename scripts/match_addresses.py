@@ -1,12 +1,24 @@
 import pandas
 import geopandas as geo
+import numpy as np
 import os
+import glob
 import re
 import regex
 import json
-from typing import List, NotRequired, TypedDict, cast
-from utils import concat, Utils, get_building_order, save_zip, capitalize_every_word
-from const import all_regex, odd_regex, even_regex, building_num_regex, building_letter_regex, district_types, dash_regex, multiple_number_regex, building_types_regex
+import hashlib
+import time
+import argparse
+import logging
+import logging.handlers
+import sys
+import pyarrow as pa
+import pyarrow.compute as pc
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from collections import Counter
+from typing import Callable, Dict, FrozenSet, Iterable, List, NotRequired, Set, Tuple, TypedDict, cast
+from utils import concat, Utils, get_building_order, building_num_pattern, building_letter_pattern, save_parquet, load_table, save_arrow_shards, load_arrow, read_arrow, Shards, GeometryIndex, load_geometry_index, apply_schema, remove_categories, address_schema, street_schema, capitalize_every_word, BordersCache, get_rules_hash, normalizer_version, hash_teryt_rows, get_inputs, is_up_to_date, load_manifest, save_manifest, rule_files, OutputWriter, write_output, save_geojson, prefetch
+from const import all_regex, odd_regex, even_regex, building_num_regex, district_types, dash_regex, multiple_number_regex, building_types_regex
 
 pandas.options.mode.copy_on_write = True
 
@@ -17,8 +29,29 @@ except_regex = r"^(bez|oprócz)$"
 
 DEBUG = True
 
+# Matching only uses attributes, geometry is attached to the matched addresses when they are saved
+address_columns = ["teryt", "town", "street", "no_type", "no_repl", "no_rep_typ", "building", "building_n", "building_l", "building_o", "building_p", "f_address", "address_id"]
+street_columns = ["teryt", "town", "street", "no_type", "no_repl", "no_rep_typ"]
+
 elections = "pres_2025"
 
+street_cache_path = "cache/street_names.sqlite"
+borders_cache_path = "cache/parsed_borders.sqlite"
+manifest_path = "matched_addresses/manifest.json"
+shards_path = "cache/shards"
+default_lookahead = 1
+error_log_path = "error.log"
+diagnostics_buffer_size = 1000
+verbosity_levels = [logging.ERROR, logging.WARNING, logging.DEBUG]
+stats_path = "matched_addresses/stats"
+stats_report_path = "matched_addresses/stats.csv"
+stats_time_columns = ["seconds", "setup_seconds", "tokenizing_seconds", "address_selection_seconds", "output_seconds"]
+stats_count_columns = ["districts", "addresses", "matched_addresses", "tokens", "tokens_without_addresses", "parse_cache_hits", "ngrams", "is_street_calls", "transform_street_name_calls", "regex_substitutions", "address_rows_scanned"]
+# Has to be changed whenever matching logic changes, delta mode reuses results matched with the same version
+matcher_version = "1"
+tokens_to_skip_path = "const/tokens_to_skip.csv"
+match_rule_files = [tokens_to_skip_path, "const/extra_streets.csv", "const/tokens_to_replace.csv", "const/addresses_to_skip.csv"]
+
 class BuildingNumber(TypedDict):
   building_n: int | str
   building_l: str
@@ -49,25 +82,73 @@ class FoundStreet(TypedDict):
   street: str
   prev_token: NotRequired[ParsedToken]
 
+class TerytFilter(logging.Filter):
+  def __init__(self):
+    super().__init__()
+    self.teryt: str | None = None
+
+  def filter(self, record: logging.LogRecord):
+    record.teryt = self.teryt
+    return True
+
+class JsonLinesFormatter(logging.Formatter):
+  def format(self, record: logging.LogRecord):
+    return json.dumps({ "level": record.levelname, "teryt": getattr(record, "teryt", None), "message": record.getMessage() }, ensure_ascii=False)
+
+logger = logging.getLogger("match_addresses")
+# Without any handler logging would fall back to printing warnings to stderr
+logger.addHandler(logging.NullHandler())
+teryt_filter = TerytFilter()
+logger.addFilter(teryt_filter)
+
+def setup_diagnostics(verbosity: int = 0, json_path: str | None = None):
+  logger.handlers.clear()
+  logger.propagate = False
+  logger.setLevel(verbosity_levels[min(verbosity, len(verbosity_levels) - 1)])
+  if (json_path is None):
+    output: logging.Handler = logging.StreamHandler(sys.stdout)
+    output.setFormatter(logging.Formatter("%(message)s"))
+  else:
+    output = logging.FileHandler(json_path, encoding="utf-8")
+    output.setFormatter(JsonLinesFormatter())
+  # Messages are written once per gmina instead of line by line
+  logger.addHandler(logging.handlers.MemoryHandler(diagnostics_buffer_size, flushLevel=logging.CRITICAL, target=output))
+  errors = logging.FileHandler(error_log_path, encoding="utf-8", delay=True)
+  errors.setLevel(logging.ERROR)
+  errors.setFormatter(logging.Formatter("%(message)s"))
+  logger.addHandler(errors)
+
+def flush_diagnostics():
+  for handler in logger.handlers:
+    handler.flush()
+
 def log_error(district: pandas.Series, reason: str):
-  with open("error.log", "a") as log:
-    log.write(f"Unable to find addresses for district {district.number} in {district.town} ({district.teryt}). Full address: {district.f_address}, {district.location}. ({reason})\n")
+  logger.error("Unable to find addresses for district %s in %s (%s). Full address: %s, %s. (%s)", district.number, district.town, district.teryt, district.f_address, district.location, reason)
 
-def is_town(towns: List[str], name: str):
-  return name in towns
+# Counters and timings of the gmina which is currently matched
+stats: Counter[str] = Counter()
 
-def check_street(streets: geo.GeoDataFrame, town: str, street: str, key: str):
-  addresses_with_street = streets[(streets["town"] == town) & (streets[key] == street)]
-  if (len(addresses_with_street) > 0):
-    return addresses_with_street.index[0]
-  return -1
+def sub(pattern: str | re.Pattern[str], repl: str, string: str, count: int = 0, flags: int = 0):
+  stats["regex_substitutions"] += 1
+  return re.sub(pattern, repl, string, count=count, flags=flags)
+
+# (town, street name variant) -> street name
+StreetIndex = Dict[Tuple[str, str], str]
+
+def is_town(towns: Set[str], name: str):
+  return name in towns
 
-def is_street(streets: geo.GeoDataFrame, town: str, street: str):
+def get_street_index(streets: pandas.DataFrame) -> StreetIndex:
+  index: StreetIndex = {}
+  # Name variants are checked in order, the first street with given name wins
   for key in ["street", "no_repl", "no_type", "no_rep_typ"]:
-    idx = check_street(streets, town, street, key)
-    if (idx > -1):
-      return streets.loc[idx, "street"]
-  return ""
+    for town, name, street in zip(streets["town"], streets[key], streets["street"]):
+      index.setdefault((town, name), street)
+  return index
+
+def is_street(streets: StreetIndex, town: str, street: str):
+  stats["is_street_calls"] += 1
+  return streets.get((town, street), "")
 
 def process_token_word(word: str):
   # Remove multiple building numbers (i.e. 100/102 -> 100)
@@ -79,12 +160,12 @@ def process_token_word(word: str):
   return word
 
 def get_building_number(address: str) -> BuildingNumber:
-  match = re.search(building_num_regex, address)
+  match = building_num_pattern.search(address)
   building_n = ""
   building_l = ""
   if (match is not None and match.group(2)):
     building_n = int(match.group(2))
-  match = re.search(building_letter_regex, address)
+  match = building_letter_pattern.search(address)
   if (match is not None and match.group(1)):
     building_l = match.group(1)
 
@@ -100,766 +181,1166 @@ def get_parsed_number(num: BuildingNumber | None):
   except:
     return -1
   
-def get_addresses_for_token(token: BaseParsedToken, token_addresses: geo.GeoDataFrame):
-  token_addresses = token_addresses[token_addresses["street"] == token["street"]]
-  is_even = token["is_even"]
-  is_odd = token["is_odd"]
-
-  if (is_even or is_odd):
-    token_addresses = token_addresses[token_addresses["building_n"] >= 0]
-
-  if (is_even):
-    token_addresses = token_addresses[token_addresses["building_n"] % 2 == 0]
-  elif (is_odd):
-    token_addresses = token_addresses[token_addresses["building_n"] % 2 == 1]
-  
-  num_from = token.get("num_from")
-  num_to = token.get("num_to")
-  number = token.get("number")
-
-  if (num_from is not None or num_to is not None):
-    if (num_from is not None and num_from["building_n"] != ""):
-      token_addresses = token_addresses[token_addresses["building_o"] >= get_building_order(num_from["building_n"], num_from["building_l"])]
-    if (num_to is not None and num_to["building_n"] != ""):
-      token_addresses = token_addresses[token_addresses["building_o"] <= get_building_order(num_to["building_n"], num_to["building_l"])]
-  elif (number is not None):
-    token_addresses = token_addresses[token_addresses["building"] == number]
-
-  return token_addresses
-
-def main():
-  print("Loading data...")
-  if (os.path.isfile("error.log")):
-    os.remove("error.log")
-
-  utils = Utils()
-  args = { 
-    "converters": { "teryt": str },
-    "encoding": "utf-8",
-    "sep": ";",
+def get_address_ids(address_ids: dict[str, int], f_addresses: Iterable[str]):
+  return { address_ids[f_address] for f_address in f_addresses if f_address in address_ids }
+
+class AddressIndex:
+  # Addresses are sorted by (town, street, building_o), so every town and street is a contiguous slice
+  def __init__(self, addresses: pandas.DataFrame):
+    addresses = addresses.sort_values(["town", "street", "building_o"], kind="stable")
+    self.ids = addresses["address_id"].to_numpy()
+    self.parity = addresses["building_p"].to_numpy()
+    self.building_o = addresses["building_o"].to_numpy()
+    self.towns = self.get_slices(addresses, ["town"])
+    self.streets = self.get_slices(addresses, ["town", "street"])
+    self.numbers = addresses.groupby(["town", "street", "building"], sort=False, observed=True).indices
+
+  @staticmethod
+  def get_slices(addresses: pandas.DataFrame, columns: List[str]) -> Dict[Tuple[str, ...] | str, Tuple[int, int]]:
+    return {
+      key: (positions[0], positions[-1] + 1) for key, positions in addresses.groupby(columns, sort=False, observed=True).indices.items()
+    }
+
+  def get_town_ids(self, town: str) -> np.ndarray:
+    start, end = self.towns.get(town, (0, 0))
+    return self.ids[start:end]
+
+  def get_street_ids(self, town: str, street: str) -> np.ndarray:
+    start, end = self.streets.get((town, street), (0, 0))
+    return self.ids[start:end]
+
+  def get_token_ids(self, town: str, token: BaseParsedToken) -> np.ndarray:
+    street = token["street"]
+    is_even = token["is_even"]
+    is_odd = token["is_odd"]
+    num_from = token.get("num_from")
+    num_to = token.get("num_to")
+    number = token.get("number")
+
+    if (num_from is None and num_to is None and number is not None):
+      positions = self.numbers.get((town, street, number), np.empty(0, dtype=np.intp))
+    else:
+      start, end = self.streets.get((town, street), (0, 0))
+      building_o = self.building_o[start:end]
+      lo = 0
+      hi = len(building_o)
+      if (num_from is not None and num_from["building_n"] != ""):
+        lo = np.searchsorted(building_o, get_building_order(num_from["building_n"], num_from["building_l"]), side="left")
+      if (num_to is not None and num_to["building_n"] != ""):
+        hi = np.searchsorted(building_o, get_building_order(num_to["building_n"], num_to["building_l"]), side="right")
+      positions = np.arange(start + lo, start + max(lo, hi))
+
+    if (is_even):
+      positions = positions[self.parity[positions] == 0]
+    elif (is_odd):
+      positions = positions[self.parity[positions] == 1]
+    return self.ids[positions]
+
+class TokensToSkip(TypedDict):
+  tokens: FrozenSet[str]
+  partial_tokens: FrozenSet[str]
+  rules: List[List[str]]
+
+class RuleIndex(TypedDict):
+  # District number is None for rules which apply to every district in a gmina
+  tokens_to_skip: Dict[Tuple[str, int | None], TokensToSkip]
+  tokens_to_replace: Dict[str, Dict[str, str]]
+
+class MatchInputs(TypedDict):
+  # Every table is split by TERYT, so that a gmina never has to be filtered out of the whole country
+  districts: Shards
+  towns: Shards
+  rules: RuleIndex
+  extra_streets: Shards
+  addresses_to_skip: Shards
+
+class BordersContext(TypedDict):
+  teryt: str
+  town_names: Set[str]
+  street_index: StreetIndex
+  extra_streets: List[str]
+  tokens_to_replace: Dict[str, str]
+  vocabulary_hash: str
+
+no_tokens_to_skip: TokensToSkip = { "tokens": frozenset(), "partial_tokens": frozenset(), "rules": [] }
+
+def get_tokens_to_skip(rules: pandas.DataFrame) -> TokensToSkip:
+  partial_rules = rules[(rules["entire_token"].isna()) | (rules["entire_token"] == False)]
+  return {
+    "tokens": frozenset(rules["token"]),
+    "partial_tokens": frozenset(partial_rules["token"]),
+    "rules": rules[["token", "entire_token"]].astype(str).values.tolist(),
   }
-  districts = pandas.read_csv("data_processed/districts.csv", converters={ "teryt": str }, sep="|", encoding="utf-8")
-  tokens_to_skip = pandas.read_csv("const/tokens_to_skip.csv", **args)
-  extra_streets = pandas.read_csv("const/extra_streets.csv", **args)
-  tokens_to_replace = pandas.read_csv("const/tokens_to_replace.csv", **args)
-  addresses_to_skip = pandas.read_csv("const/addresses_to_skip.csv", **args)
-  towns = geo.read_file("data_processed/addresses/prng.zip")
-  # Force special districts to be first
-  districts.loc[districts["borders"].str.contains("Dom Pomocy Społecznej"), "type"] = "dom pomocy społecznej"
-  districts = districts.sort_values("type", key=lambda x: x.map(district_types))
-  teryts = districts["teryt"].drop_duplicates()
-  powiats = []
-  for teryt in teryts:
-    if (teryt[:4] not in powiats):
-      powiats.append(teryt[:4])
-  
-  powiats = sorted(powiats)
-
-  for i in range(16):
-    woj_teryt = str((i + 1) * 2).rjust(2, "0")
-    woj_powiats = filter(lambda x: x.startswith(woj_teryt), powiats)
-    woj_powiats = list(woj_powiats)
-    print(f"Loading data for voivodeship {woj_teryt}...")
-
-    addresses = geo.read_file(f"data_processed/addresses/{woj_teryt}.zip")
-    # For easier duplicates search
-    addresses = addresses.sort_values(["town", "street", "building_n", "building_l"])
-    addresses.loc[addresses["building_n"].isna(), "building_n"] = "-1"
-    addresses["building_n"] = addresses["building_n"].astype(int)
-
-    streets = geo.read_file(f"data_processed/streets/{woj_teryt}.zip")
-
-    for teryt in woj_powiats:
-      powiat_teryts = filter(lambda x: x.startswith(teryt), teryts)
-      powiat_teryts = sorted(list(powiat_teryts))
-      matched_addresses = process_powiat(powiat_teryts, districts, addresses, towns, streets, utils, tokens_to_skip, extra_streets, tokens_to_replace, addresses_to_skip)
-      if (matched_addresses is not None):
-        save_zip(f"matched_addresses/{teryt}", matched_addresses)
-      else:
-        raise ValueError(f"No addresses matched found for powiat {teryt}!")
-
-def process_powiat(
-    teryts: List[str],
-    districts: pandas.DataFrame,
-    addresses: geo.GeoDataFrame,
-    towns: geo.GeoDataFrame,
-    streets: geo.GeoDataFrame,
-    utils: Utils,
-    tokens_to_skip_df: pandas.DataFrame,
-    extra_streets_df: pandas.DataFrame,
-    tokens_to_replace_df: pandas.DataFrame,
-    addresses_to_skip_df: pandas.DataFrame,
-  ):
-  powiat_addresses: geo.GeoDataFrame | None = None
-
-  for teryt in teryts:
-    print(f"Processing {teryt}...")
-    teryt_districts = districts[districts["teryt"] == teryt]
-    teryt_addresses = addresses[addresses["teryt"] == teryt]
-    teryt_towns = towns[towns["teryt"] == teryt]
-    all_towns = [ *teryt_towns["town"].to_list(), *teryt_addresses["town"].to_list() ]
-    town_list = []
-    for town in all_towns:
-      if (not town in town_list):
-        town_list.append(town)
-
-    tokens_to_replace = tokens_to_replace_df[tokens_to_replace_df["teryt"] == teryt]
-    addresses_to_skip = addresses_to_skip_df[addresses_to_skip_df["teryt"] == teryt]["f_address"].tolist()
-    # Extra streets have to be parsed but will be discarded anyway
-    extra_streets = extra_streets_df[extra_streets_df["teryt"] == teryt]
-    extra_streets_list = extra_streets["street"].to_list()
-    # Streets in Warsaw are assigned to city-wide TERYT instead of districts
-    teryt_streets = streets[streets["teryt"] == ("146501" if teryt.startswith("1465") else teryt)]
-    teryt_streets = concat(teryt_streets, extra_streets)
-    teryt_streets = concat(teryt_streets, teryt_addresses)
-    teryt_streets = teryt_streets.reset_index()
-    teryt_streets = teryt_streets.drop_duplicates(["town", "street"])
-    addresses_out: geo.GeoDataFrame | None = None
-    processed_rows = 0
-    special_addresses = []
-    for i, district in teryt_districts.iterrows():
-      if (processed_rows != 0 and processed_rows % 10 == 0):
-        print(f"Processed {processed_rows} out of {len(teryt_districts)} districts...")
-
-      district_id = f"{teryt}_{district.number}"
-      district_addresses: geo.GeoDataFrame | None = None
-      district_tokens_to_skip = tokens_to_skip_df[
-        (tokens_to_skip_df["teryt"] == teryt) & 
-        ((tokens_to_skip_df["district"].isna()) | (tokens_to_skip_df["district"] == district.number)) & 
-        ((tokens_to_skip_df["elections"].isna()) | (tokens_to_skip_df["elections"] == elections))
-      ]
-      tokens_to_skip = district_tokens_to_skip["token"].tolist()
-      if (district.type != "stały"):
-        district_addresses = teryt_addresses[teryt_addresses["f_address"] == district.f_address]
-        special_addresses.append(district.f_address)
-        if (len(teryt_districts) == 0):
-          # TODO: Attempt geocoding address using API
-          pass
-        if (district_addresses is not None):
-          district_addresses["district"] = district_id
-          addresses_out = concat(addresses_out, district_addresses)
-        processed_rows += 1
-        continue
-      
-      borders = district.borders
-      borders = re.sub(dash_regex, "-", borders)
-      borders = re.sub(r"((^|\s+)o\s+)?(nr\.?|n-?ry|numer(u|y|ów)?):?\s+(posesji|blok(u|ów)\s+)?", " ", borders, flags=re.IGNORECASE)
-      borders = re.sub(r"[()]", "", borders)
-      borders = re.sub(r"(,\s*|\s+)(bez|oprócz|z wyłączeniem|za? wyjątkiem)(\s+(numer|nr\.?)(u|ów))?(\s+(blok|bl\.?)(u|ów))?(\s+ulicy?)?", ", bez", borders, flags=re.IGNORECASE)
-      borders = re.sub(r"część\s+(gminy|sołectwa|miasta)\s+(\w+|w skład której wchodzą miejscowości|obejmując[ae])", "", borders, flags=re.IGNORECASE)
-      borders = re.sub(r"sołectwo\s+((\S+)(\s+\S+){0,2})\s+((obejmujące\s+(wieś|przysiółek|miejscowość|miejscowości):?)|z (wsią|miejscowością|miejscowościami):?)\s+\1", r"\1", borders, flags=re.IGNORECASE)
-      borders = re.sub(r"\s+", " ", borders)
-      split_borders: List[str] = re.split(r",\s*", borders.replace(";", ","))
-
-      parsed_tokens: List[ParsedToken] = []
-      town = None
-      last_town = ""
-      last_street = ""
-      last_is_odd = False
-      last_is_even = False
-      is_except = False
-      check_after_parity = False
-      restored_token: ParsedToken | None = None
-      restored_town = ""
-      all_tokens_to_skip = tokens_to_skip.copy()
-      for token in split_borders:
-        token = token.strip()
-        tokens_to_skip = all_tokens_to_skip
-        if (len(token) == 0 or token == "." or token in tokens_to_skip):
-          print(f"Skipping token {token}...")
-          continue
 
-        token_replacement = tokens_to_replace[tokens_to_replace["token"] == token]
-        if (len(token_replacement) > 0):
-          token_replacement = token_replacement.iloc[0].replacement
-          print(f"Replacing {token} with {token_replacement}...")
-          token = token_replacement
-
-        token = re.sub(r"(\s*-\s*|\s+)oficyn[ay]", "", token, flags=re.IGNORECASE)
-        token = re.sub(r"(\s*-\s*|\s+)(bloki?|budynki|budynek|dom[uy]?|posesji)\s+", " ", token, flags=re.IGNORECASE)
-        token = re.sub(r"(gmina|sołectwo|miasto)\s+(\S+(\s+\S+){0,3})\s*-część", "", token, flags=re.IGNORECASE)
-        token = re.sub(r"\s*-\s*((nie)?parz[yv]ste)", r" \1", token, flags=re.IGNORECASE)
-        token = re.sub("obie strony", "wszystkie", token, flags=re.IGNORECASE)
-        token = re.sub("do końca numeracji", "do końca", token, flags=re.IGNORECASE)
-        token = re.sub("-do końca", " do końca", token, flags=re.IGNORECASE)
-        token = re.sub(r"\s*/\.?$", "", token) # See: Olsztyn
-        token = re.sub(r"\s*:", "", token)
-        token = re.sub(r"\.$", "", token)
-
-        if (token == ""):
+def get_election_tokens_to_skip(tokens_to_skip_df: pandas.DataFrame):
+  return tokens_to_skip_df[(tokens_to_skip_df["elections"].isna()) | (tokens_to_skip_df["elections"] == elections)]
+
+def get_rule_index(tokens_to_skip_df: pandas.DataFrame, tokens_to_replace_df: pandas.DataFrame) -> RuleIndex:
+  tokens_to_skip_df = get_election_tokens_to_skip(tokens_to_skip_df)
+  tokens_to_skip: Dict[Tuple[str, int | None], TokensToSkip] = {}
+  for teryt, teryt_rules in tokens_to_skip_df.groupby("teryt", sort=False):
+    tokens_to_skip[(teryt, None)] = get_tokens_to_skip(teryt_rules[teryt_rules["district"].isna()])
+    for number in teryt_rules["district"].dropna().unique():
+      tokens_to_skip[(teryt, int(number))] = get_tokens_to_skip(teryt_rules[(teryt_rules["district"].isna()) | (teryt_rules["district"] == number)])
+
+  tokens_to_replace: Dict[str, Dict[str, str]] = {}
+  for rule in tokens_to_replace_df.itertuples():
+    # The first replacement of a token wins
+    tokens_to_replace.setdefault(rule.teryt, {}).setdefault(rule.token, rule.replacement)
+  return { "tokens_to_skip": tokens_to_skip, "tokens_to_replace": tokens_to_replace }
+
+def get_vocabulary_hash(town_names: Set[str], street_index: StreetIndex, extra_streets: List[str]):
+  # Extra streets don't have all name variants, so keys can contain NaN
+  vocabulary = [sorted(town_names), sorted(street_index.items(), key=str), sorted(extra_streets)]
+  return hashlib.sha256(json.dumps(vocabulary, ensure_ascii=False).encode()).hexdigest()
+
+def get_borders_key(context: BordersContext, district: pandas.Series, district_tokens_to_skip: TokensToSkip):
+  # Only rules which can change the parsed tokens of this district are part of the key
+  key = {
+    "teryt": context["teryt"],
+    "town": district.town,
+    "borders": district.borders,
+    "vocabulary": context["vocabulary_hash"],
+    "tokens_to_skip": district_tokens_to_skip["rules"],
+    "tokens_to_replace": [[str(token), str(replacement)] for token, replacement in context["tokens_to_replace"].items()],
+  }
+  return hashlib.sha256(json.dumps(key, ensure_ascii=False).encode()).hexdigest()
+
+def get_parsed_tokens(context: BordersContext, district: pandas.Series, district_tokens_to_skip: TokensToSkip, utils: Utils, borders_cache: BordersCache | None) -> List[ParsedToken]:
+  if (borders_cache is None):
+    return parse_borders(context, district, district_tokens_to_skip, utils)
+
+  key = get_borders_key(context, district, district_tokens_to_skip)
+  parsed_tokens = borders_cache.get(key)
+  if (parsed_tokens is not None):
+    stats["parse_cache_hits"] += 1
+  else:
+    parsed_tokens = parse_borders(context, district, district_tokens_to_skip, utils)
+    borders_cache.set(key, parsed_tokens)
+  return parsed_tokens
+
+def parse_borders(context: BordersContext, district: pandas.Series, district_tokens_to_skip: TokensToSkip, utils: Utils) -> List[ParsedToken]:
+  teryt = context["teryt"]
+  town_names = context["town_names"]
+  street_index = context["street_index"]
+  extra_streets_list = context["extra_streets"]
+  tokens_to_replace = context["tokens_to_replace"]
+  all_tokens_to_skip = district_tokens_to_skip["tokens"]
+  partial_tokens_to_skip = district_tokens_to_skip["partial_tokens"]
+
+  borders = district.borders
+  borders = sub(dash_regex, "-", borders)
+  borders = sub(r"((^|\s+)o\s+)?(nr\.?|n-?ry|numer(u|y|ów)?):?\s+(posesji|blok(u|ów)\s+)?", " ", borders, flags=re.IGNORECASE)
+  borders = sub(r"[()]", "", borders)
+  borders = sub(r"(,\s*|\s+)(bez|oprócz|z wyłączeniem|za? wyjątkiem)(\s+(numer|nr\.?)(u|ów))?(\s+(blok|bl\.?)(u|ów))?(\s+ulicy?)?", ", bez", borders, flags=re.IGNORECASE)
+  borders = sub(r"część\s+(gminy|sołectwa|miasta)\s+(\w+|w skład której wchodzą miejscowości|obejmując[ae])", "", borders, flags=re.IGNORECASE)
+  borders = sub(r"sołectwo\s+((\S+)(\s+\S+){0,2})\s+((obejmujące\s+(wieś|przysiółek|miejscowość|miejscowości):?)|z (wsią|miejscowością|miejscowościami):?)\s+\1", r"\1", borders, flags=re.IGNORECASE)
+  borders = sub(r"\s+", " ", borders)
+  split_borders: List[str] = re.split(r",\s*", borders.replace(";", ","))
+
+  parsed_tokens: List[ParsedToken] = []
+  town = None
+  last_town = ""
+  last_street = ""
+  last_is_odd = False
+  last_is_even = False
+  is_except = False
+  check_after_parity = False
+  restored_token: ParsedToken | None = None
+  restored_town = ""
+  for token in split_borders:
+    token = token.strip()
+    if (len(token) == 0 or token == "." or token in all_tokens_to_skip):
+      logger.debug("Skipping token %s...", token)
+      continue
+
+    token_replacement = tokens_to_replace.get(token)
+    if (token_replacement is not None):
+      logger.debug("Replacing %s with %s...", token, token_replacement)
+      token = token_replacement
+
+    token = sub(r"(\s*-\s*|\s+)oficyn[ay]", "", token, flags=re.IGNORECASE)
+    token = sub(r"(\s*-\s*|\s+)(bloki?|budynki|budynek|dom[uy]?|posesji)\s+", " ", token, flags=re.IGNORECASE)
+    token = sub(r"(gmina|sołectwo|miasto)\s+(\S+(\s+\S+){0,3})\s*-część", "", token, flags=re.IGNORECASE)
+    token = sub(r"\s*-\s*((nie)?parz[yv]ste)", r" \1", token, flags=re.IGNORECASE)
+    token = sub("obie strony", "wszystkie", token, flags=re.IGNORECASE)
+    token = sub("do końca numeracji", "do końca", token, flags=re.IGNORECASE)
+    token = sub("-do końca", " do końca", token, flags=re.IGNORECASE)
+    token = sub(r"\s*/\.?$", "", token) # See: Olsztyn
+    token = sub(r"\s*:", "", token)
+    token = sub(r"\.$", "", token)
+
+    if (token == ""):
+      continue
+
+    town_tmp = ""
+    split_town_line = re.split(r"\s+", token)
+    idx = 0
+    towns_in_token: List[FoundTown | None] = []
+    is_except_token = False
+
+    while (idx < len(split_town_line)):
+      end_idx = idx
+      found_town: FoundTown | None = None
+      for word in split_town_line[idx:]:
+        end_idx += 1
+        stats["ngrams"] += 1
+        town_tmp = " ".join(split_town_line[idx:end_idx])
+        # Here we only skip parts of token that we don't want to be parsed (e.g. old town names as street names)
+        if (town_tmp in partial_tokens_to_skip):
+          logger.debug("Skipping part of town %s...", town_tmp)
           continue
 
-        partial_tokens_to_skip = district_tokens_to_skip[(district_tokens_to_skip["entire_token"].isna()) | (district_tokens_to_skip["entire_token"] == False)]
-        tokens_to_skip = partial_tokens_to_skip["token"].tolist()
-        town_tmp = ""
-        split_town_line = re.split(r"\s+", token)
-        idx = 0
-        towns_in_token: List[FoundTown | None] = []
-        is_except_token = False
-
-        while (idx < len(split_town_line)):
-          end_idx = idx
-          found_town: FoundTown | None = None
-          for word in split_town_line[idx:]:
-            end_idx += 1
-            town_tmp = " ".join(split_town_line[idx:end_idx])
-            # Here we only skip parts of token that we don't want to be parsed (e.g. old town names as street names)
-            if (town_tmp in tokens_to_skip):
-              print(f"Skipping part of town {town_tmp}...")
-              continue
-
-            if (idx == 0 and re.match(except_regex, word)):
-              is_except_token = True
+        if (idx == 0 and re.match(except_regex, word)):
+          is_except_token = True
 
-            ends_with_dot = town_tmp.endswith(".")
-            town_tmp = re.sub(r"\.$", "", town_tmp)
-            town_tmp_replaced = re.sub(place_type, "", town_tmp + " ").strip()
-            if (len(town_tmp_replaced) != 0):
-              town_tmp = town_tmp_replaced
+        ends_with_dot = town_tmp.endswith(".")
+        town_tmp = sub(r"\.$", "", town_tmp)
+        town_tmp_replaced = sub(place_type, "", town_tmp + " ").strip()
+        if (len(town_tmp_replaced) != 0):
+          town_tmp = town_tmp_replaced
 
-            town_capitalized = capitalize_every_word(town_tmp)
-            if (is_town(town_list, town_capitalized)):
-              town_tmp = town_capitalized
+        town_capitalized = capitalize_every_word(town_tmp)
+        if (is_town(town_names, town_capitalized)):
+          town_tmp = town_capitalized
 
-            town_split = town_tmp.split("-")[0]
-            found_token_split = found_town["town"].split("-")[0] if found_town else ""
-            if (town_split != found_token_split and is_town(town_list, town_split) and not is_town(town_list, town_tmp)):
-              town_tmp = town_split
+        town_split = town_tmp.split("-")[0]
+        found_token_split = found_town["town"].split("-")[0] if found_town else ""
+        if (town_split != found_token_split and is_town(town_names, town_split) and not is_town(town_names, town_tmp)):
+          town_tmp = town_split
 
-            town_with_dash = "-".join(town_tmp.split(" ")).replace("---", "-")
-            if (is_town(town_list, town_with_dash)):
-              town_tmp = town_with_dash
+        town_with_dash = "-".join(town_tmp.split(" ")).replace("---", "-")
+        if (is_town(town_names, town_with_dash)):
+          town_tmp = town_with_dash
 
-            street_name = is_street(teryt_streets, last_town, town_tmp)
-            town_found = is_town(town_list, town_tmp)
-            if (end_idx > 1 and street_name != "" and not town_found):
-              idx = end_idx
-              continue
+        street_name = is_street(street_index, last_town, town_tmp)
+        town_found = is_town(town_names, town_tmp)
+        if (end_idx > 1 and street_name != "" and not town_found):
+          idx = end_idx
+          continue
 
-            if (town_found and street_name == "" and (not found_town or found_town["town"] != town_tmp)):
-              last_town = town_tmp
-              found_town = {
-                "town": town_tmp,
-                "start_index": idx,
-                "end_index": end_idx
-              }
-              if (idx != 0 and len(towns_in_token) == 0):
-                  try:
-                    prev_token = parsed_tokens[-1]
-                    prev_found_town: FoundTown = {
-                      "town": prev_token["town"],
-                      "start_index": 0,
-                      "end_index": 0,
-                    }
-                    towns_in_token.append(prev_found_town)
-                  except:
-                    print(f"No previous token found for string \"{" ".join(split_town_line[0:idx])}\"!")
-              # End of line was reached
-              if (end_idx == len(split_town_line) or ends_with_dot):
-                towns_in_token.append(found_town)
-                idx = end_idx
-
-            # Handle cases such as Grabów nad Pilicą
-            elif (found_town is not None and (end_idx == found_town["end_index"] + 2 or end_idx == len(split_town_line))):
-              towns_in_token.append(found_town)
-              idx = found_town["end_index"]
-              break
-
-          if (found_town is None):
-            idx += 1
-
-        prev_town_end = len(split_town_line)
-        towns_in_token.reverse()
-        if (len(towns_in_token) == 0):
-          towns_in_token = [None]
-
-        for town in towns_in_token:
-          parsed_token: ParsedToken = {
-            "token": token,
-            "is_town": False,
-            "is_street": False,
-            "is_odd": False,
-            "is_even": False,
-            "town": "",
-            "street": "",
-            "except_addresses": []
+        if (town_found and street_name == "" and (not found_town or found_town["town"] != town_tmp)):
+          last_town = town_tmp
+          found_town = {
+            "town": town_tmp,
+            "start_index": idx,
+            "end_index": end_idx
           }
+          if (idx != 0 and len(towns_in_token) == 0):
+              try:
+                prev_token = parsed_tokens[-1]
+                prev_found_town: FoundTown = {
+                  "town": prev_token["town"],
+                  "start_index": 0,
+                  "end_index": 0,
+                }
+                towns_in_token.append(prev_found_town)
+              except:
+                logger.warning("No previous token found for string \"%s\"!", " ".join(split_town_line[0:idx]))
+          # End of line was reached
+          if (end_idx == len(split_town_line) or ends_with_dot):
+            towns_in_token.append(found_town)
+            idx = end_idx
+
+        # Handle cases such as Grabów nad Pilicą
+        elif (found_town is not None and (end_idx == found_town["end_index"] + 2 or end_idx == len(split_town_line))):
+          towns_in_token.append(found_town)
+          idx = found_town["end_index"]
+          break
+
+      if (found_town is None):
+        idx += 1
+
+    prev_town_end = len(split_town_line)
+    towns_in_token.reverse()
+    if (len(towns_in_token) == 0):
+      towns_in_token = [None]
+
+    for town in towns_in_token:
+      parsed_token: ParsedToken = {
+        "token": token,
+        "is_town": False,
+        "is_street": False,
+        "is_odd": False,
+        "is_even": False,
+        "town": "",
+        "street": "",
+        "except_addresses": []
+      }
+
+      if (town is not None):
+        token = " ".join(split_town_line[town["start_index"]:prev_town_end])
+        
+        if (token == "i" or token == "oraz"):
+          continue
 
-          if (town is not None):
-            token = " ".join(split_town_line[town["start_index"]:prev_town_end])
-            
-            if (token == "i" or token == "oraz"):
-              continue
+        rest_of_token = " ".join(split_town_line[town["end_index"]:prev_town_end])
+        rest_of_token = sub(r"(^|\s+)(i|oraz|z miejscowością|z miejscowościami)$", "", rest_of_token)
+        rest_of_token = sub(place_type, "", rest_of_token + " ")
+        rest_of_token = sub(f"^{town["town"]}(\\s+|$)", "", rest_of_token).strip()
+        prev_town_end = town["start_index"]
+        parsed_token["town"] = town["town"]
+        parsed_token["street"] = town["town"]
+        last_town = town["town"]
+        last_street = town["town"]
+        parsed_token["token"] = token
+        is_except = False
+        is_except_token = bool(re.match(r"^(bez|oprócz)\s+", rest_of_token))
+
+        if (len(rest_of_token) == 0 or is_except_token):
+          parsed_token["is_town"] = True
+          prev_token = parsed_tokens[-1] if len(parsed_tokens) > 0 else None
+          if (not prev_token or prev_token["town"] != town["town"] or is_except_token):
+            parsed_tokens.append(parsed_token)
+            parsed_token = parsed_token.copy()
+          if (not is_except_token):
+            continue
+      else:
+        parsed_token["town"] = last_town
+        parsed_token["street"] = last_street
+        rest_of_token = " ".join(split_town_line)
+        # Handle cases where town name is repeated multiple times
+        rest_of_token = sub(f"{last_town}\\s+", " ", rest_of_token, 1)
 
-            rest_of_token = " ".join(split_town_line[town["end_index"]:prev_town_end])
-            rest_of_token = re.sub(r"(^|\s+)(i|oraz|z miejscowością|z miejscowościami)$", "", rest_of_token)
-            rest_of_token = re.sub(place_type, "", rest_of_token + " ")
-            rest_of_token = re.sub(f"^{town["town"]}(\\s+|$)", "", rest_of_token).strip()
-            prev_town_end = town["start_index"]
-            parsed_token["town"] = town["town"]
-            parsed_token["street"] = town["town"]
-            last_town = town["town"]
-            last_street = town["town"]
-            parsed_token["token"] = token
-            is_except = False
-            is_except_token = bool(re.match(r"^(bez|oprócz)\s+", rest_of_token))
-
-            if (len(rest_of_token) == 0 or is_except_token):
-              parsed_token["is_town"] = True
-              prev_token = parsed_tokens[-1] if len(parsed_tokens) > 0 else None
-              if (not prev_token or prev_token["town"] != town["town"] or is_except_token):
-                parsed_tokens.append(parsed_token)
-                parsed_token = parsed_token.copy()
-              if (not is_except_token):
-                continue
-          else:
-            parsed_token["town"] = last_town
-            parsed_token["street"] = last_street
-            rest_of_token = " ".join(split_town_line)
-            # Handle cases where town name is repeated multiple times
-            rest_of_token = re.sub(f"{last_town}\\s+", " ", rest_of_token, 1)
+      token = sub(place_type, "", rest_of_token).strip()
+      
+      if (parsed_token["town"] == ""):
+        parsed_token["town"] = district.town
+        last_town = district.town
+      
+      token = sub(streets_regex, " ", token).strip()
+      token = sub(r"\s+", " ", token)
+      token = sub(f"^{dash_regex}\\s*", "", token)
+      prev_token = parsed_tokens[-1] if len(parsed_tokens) > 0 else None
+      restored_prev_token = False
+
+      if (not is_except_token and (town is not None or restored_town != parsed_token["town"]) and prev_token and prev_token["town"] == parsed_token["town"] and prev_token["is_town"]):
+        restored_prev_token = True
+        restored_town = parsed_token["town"]
+        if (restored_town not in parsed_token["token"]):
+          parsed_token = parsed_tokens.pop()
+          parsed_token["is_town"] = False
+        else:
+          continue
 
-          token = place_type.sub("", rest_of_token).strip()
-          
-          if (parsed_token["town"] == ""):
-            parsed_token["town"] = district.town
-            last_town = district.town
-          
-          token = streets_regex.sub(" ", token).strip()
-          token = re.sub(r"\s+", " ", token)
-          token = re.sub(f"^{dash_regex}\\s*", "", token)
-          prev_token = parsed_tokens[-1] if len(parsed_tokens) > 0 else None
-          restored_prev_token = False
+      street_tmp = ""
+      split_line = re.split(r"\s+", token)
+      streets_in_token: List[FoundStreet | None] = []
+      idx = 0
+      skipped_token = False
+      while idx < len(split_line):
+        end_idx = idx
+        found_street: FoundStreet | None = None
+        for word in split_line[idx:]:
+          end_idx += 1
+          stats["ngrams"] += 1
+          street_tmp = " ".join(split_line[idx:end_idx])
+          ends_with_dot = street_tmp.endswith(".")
+          if (street_tmp in partial_tokens_to_skip):
+            logger.debug("Skipping part of street %s...", street_tmp)
+            skipped_token = True
+            idx = end_idx - 1
+            break
+          street_tmp = utils.transform_street_name(street_tmp, teryt)
+          stats["transform_street_name_calls"] += 1
+
+          street_name = cast(str, is_street(street_index, parsed_token["town"], street_tmp))
+          if (street_name != ""):
+            last_street = street_name
+            found_street = {
+              "street": street_name,
+              "start_index": idx,
+              "end_index": end_idx
+            }
+            start_of_token = " ".join(split_line[0:idx]) + " "
+            start_of_token = utils.transform_street_name(start_of_token, teryt) + " "
+            stats["transform_street_name_calls"] += 1
+            start_of_token = utils.remove_street_type(start_of_token) + " "
+            start_of_token = utils.remove_replacements(start_of_token).strip()
+            start_of_token = sub(except_regex, "", start_of_token, flags=re.IGNORECASE)
+            # Street was found later in the token, but the first part of the token was not included
+            if (not skipped_token and len(start_of_token) > 0 and idx != 0 and len(streets_in_token) == 0 and not re.match(except_regex, start_of_token)):
+              try:
+                prev_token = parsed_tokens[-1]
+                prev_found_street: FoundStreet = {
+                  "street": prev_token["street"],
+                  "start_index": 0,
+                  "end_index": 0, # If street was not found previously that means it's not in the token so nothing will be cut
+                  "prev_token": prev_token
+                }
+                streets_in_token.append(prev_found_street)
+              except:
+                logger.warning("No previous token found for string \"%s\"!", " ".join(split_line[0:idx]))
+            elif (skipped_token):
+              skipped_token = False
+            # End of line was reached
+            if (end_idx == len(split_line) or ends_with_dot):
+              streets_in_token.append(found_street)
+              idx = end_idx
+          # Account for "name and name surname" case (e.g. Heleny i Leona Patynów in Kraków)
+          elif (found_street is not None and (end_idx == found_street["end_index"] + 3 or end_idx == len(split_line))):
+            streets_in_token.append(found_street)
+            idx = found_street["end_index"]
+            break
+
+        if (found_street is None):
+          idx += 1
+
+      prev_end = len(split_line)
+      streets_in_token.reverse()
+      if (len(streets_in_token) == 0):
+        streets_in_token = [None]
+
+      for street in streets_in_token:
+        tmp_token = parsed_token.copy()
+        prev_token = parsed_tokens[-1] if len(parsed_tokens) > 0 else None
+        except_with_street_name = False
+
+        if (street is not None):
+          token = " ".join(split_line[street["start_index"]:prev_end])
+          rest_of_token = " ".join(split_line[street["end_index"]:prev_end])
+          rest_of_token = sub(r"(^|\s+)(i|oraz)$", "", rest_of_token)
+          overlapping_streets = prev_end < street["end_index"]
+          prev_end = street["start_index"]
+        
+          if (overlapping_streets):
+            logger.warning("⚠️ Skipping overlapping street %s in token %s...", street, " ".join(split_line))
+            logger.debug("Found streets: %s.", streets_in_token)
+            continue
+
+          parsed_token["street"] = street["street"]
+          parsed_token["is_town"] = False
+          parsed_token["token"] = token
+          parsed_token["except_addresses"] = []
+          is_except = is_except_token
+          restored_token = None
+
+          if ("prev_token" in street):
+            prev_token = street["prev_token"]
+            parsed_token["is_even"] = prev_token["is_even"]
+            parsed_token["is_odd"] = prev_token["is_odd"]
+
+          # We found new street, restart token to default settings
+          tmp_token["street"] = street["street"]
+
+          if (len(rest_of_token) == 0):
+            parsed_token["is_street"] = True
+            if (is_except_token and prev_token):
+              prev_token["except_addresses"].append(parsed_token)
+            elif (prev_token and prev_token["street"] == parsed_token["street"] and prev_token["is_street"]):
+              # No need to duplicate tokens
+              continue
+            elif (not is_except_token):
+              parsed_tokens.append(parsed_token)
+            parsed_token = tmp_token.copy()
+            continue
+          if (re.match(r"bez|oprócz", rest_of_token)):
+            parsed_token["is_street"] = True
+            except_with_street_name = True
+        else:
+          parsed_token["street"] = last_street if last_street != "" else last_town
+          if (not prev_token or prev_token["town"] == parsed_token["town"]):
+            parsed_token["is_even"] = last_is_even
+            parsed_token["is_odd"] = last_is_odd
+          rest_of_token = " ".join(split_line)
 
-          if (not is_except_token and (town is not None or restored_town != parsed_token["town"]) and prev_token and prev_token["town"] == parsed_token["town"] and prev_token["is_town"]):
+        if (parsed_token["street"] in extra_streets_list):
+          continue
+        
+        rest_of_token = sub(dash_regex, "-", rest_of_token)
+        rest_of_token = sub(r"^/", "", rest_of_token) # See: Olsztyn
+        rest_of_token = sub(building_types_regex, "", rest_of_token)
+        rest_of_token = sub(r"(\w+)\s+\1", r"\1", rest_of_token)
+        split_token = re.split(r"\s+", rest_of_token.strip())
+        prev_word = ""
+        next_word = ""
+        word_idx = -1
+        skip_token = False
+        set_parity = False
+        
+        if (prev_token and prev_token["street"] == parsed_token["street"] and prev_token["is_street"]):
+          if (not restored_prev_token):
+            parsed_token = parsed_tokens.pop()
             restored_prev_token = True
-            restored_town = parsed_token["town"]
-            if (restored_town not in parsed_token["token"]):
-              parsed_token = parsed_tokens.pop()
-              parsed_token["is_town"] = False
+          parsed_token["is_street"] = False
+
+        for word in split_token:
+          word_idx += 1
+          next_word = split_token[word_idx + 1] if word_idx < len(split_token) - 1 else ""
+          word = sub(r"[():]", "", word)
+
+          if (check_after_parity):
+            prev_token = parsed_tokens[-1]
+            check_after_parity = False
+            if (parsed_token["street"] == prev_token["street"]):
+              restored_prev_token = True
+              restored_token = parsed_tokens.pop()
+              parsed_token = restored_token.copy()
+
+          if (word == "i" or word == "oraz"):
+            if (word_idx > 0 and not is_except):
+              parsed_tokens.append(parsed_token)
+            elif (word_idx > 0 and is_except):
+              prev_token = parsed_tokens.pop()
+              prev_token["except_addresses"].append(parsed_token)
+              parsed_tokens.append(prev_token)
+              is_except = next_word != ""
+            if (next_word == ""):
+              # This token has already been handled, no need to add it later
+              skip_token = True
+            parsed_token = parsed_token.copy()
+            parsed_token.pop("num_from", None)
+            parsed_token.pop("num_to", None)
+            parsed_token.pop("number", None)
+            prev_word = word
+            set_parity = False
+            continue
+
+          if (word == "wszystkie"):
+            if (not set_parity):
+              parsed_token["is_odd"] = False
+              parsed_token["is_even"] = False
+            prev_word = word
+            continue
+
+          if (word == "strona"):
+            prev_word = word
+            continue
+
+          split_by_dash = re.split(dash_regex, word)
+          is_dash = re.match(f"^{dash_regex}$", word)
+          prev_is_dash = re.match(f"^{dash_regex}$", prev_word)
+          ends_with_dash = not is_dash and re.search(f"({dash_regex})$", word) is not None
+          starts_with_dash = not is_dash and re.search(f"^({dash_regex})", word) is not None
+          starts_with_from = word != "od" and word.startswith("od")
+          starts_with_to = word != "do" and word.startswith("do")
+          ends_with_to = word != "do" and word.endswith("do")
+
+          if (ends_with_dash):
+            word = word[:-1]
+            word_idx += 1
+          if (ends_with_to):
+            word = word[:-2]
+            word_idx += 1
+
+          if (starts_with_dash):
+            word = word[1:]
+            prev_word = "-"
+            prev_is_dash = True
+            word_idx += 1
+          if (starts_with_from or starts_with_to):
+            word = word[2:]
+            if (starts_with_from):
+              prev_word = "od"
+              word_idx += 1
             else:
-              continue
+              prev_word = "do"
+              word_idx += 1
 
-          street_tmp = ""
-          split_line = re.split(r"\s+", token)
-          streets_in_token: List[FoundStreet | None] = []
-          idx = 0
-          skipped_token = False
-          while idx < len(split_line):
-            end_idx = idx
-            found_street: FoundStreet | None = None
-            for word in split_line[idx:]:
-              end_idx += 1
-              street_tmp = " ".join(split_line[idx:end_idx])
-              ends_with_dot = street_tmp.endswith(".")
-              if (street_tmp in tokens_to_skip):
-                print(f"Skipping part of street {street_tmp}...")
-                skipped_token = True
-                idx = end_idx - 1
-                break
-              street_tmp = utils.transform_street_name(street_tmp, teryt)
-
-              street_name = cast(str, is_street(teryt_streets, parsed_token["town"], street_tmp))
-              if (street_name != ""):
-                last_street = street_name
-                found_street = {
-                  "street": street_name,
-                  "start_index": idx,
-                  "end_index": end_idx
-                }
-                start_of_token = " ".join(split_line[0:idx]) + " "
-                start_of_token = utils.transform_street_name(start_of_token, teryt) + " "
-                start_of_token = utils.remove_street_type(start_of_token) + " "
-                start_of_token = utils.remove_replacements(start_of_token).strip()
-                start_of_token = re.sub(except_regex, "", start_of_token, flags=re.IGNORECASE)
-                # Street was found later in the token, but the first part of the token was not included
-                if (not skipped_token and len(start_of_token) > 0 and idx != 0 and len(streets_in_token) == 0 and not re.match(except_regex, start_of_token)):
-                  try:
-                    prev_token = parsed_tokens[-1]
-                    prev_found_street: FoundStreet = {
-                      "street": prev_token["street"],
-                      "start_index": 0,
-                      "end_index": 0, # If street was not found previously that means it's not in the token so nothing will be cut
-                      "prev_token": prev_token
-                    }
-                    streets_in_token.append(prev_found_street)
-                  except:
-                    print(f"No previous token found for string \"{" ".join(split_line[0:idx])}\"!")
-                elif (skipped_token):
-                  skipped_token = False
-                # End of line was reached
-                if (end_idx == len(split_line) or ends_with_dot):
-                  streets_in_token.append(found_street)
-                  idx = end_idx
-              # Account for "name and name surname" case (e.g. Heleny i Leona Patynów in Kraków)
-              elif (found_street is not None and (end_idx == found_street["end_index"] + 3 or end_idx == len(split_line))):
-                streets_in_token.append(found_street)
-                idx = found_street["end_index"]
-                break
-
-            if (found_street is None):
-              idx += 1
-
-          prev_end = len(split_line)
-          streets_in_token.reverse()
-          if (len(streets_in_token) == 0):
-            streets_in_token = [None]
-
-          for street in streets_in_token:
-            tmp_token = parsed_token.copy()
-            prev_token = parsed_tokens[-1] if len(parsed_tokens) > 0 else None
-            except_with_street_name = False
-
-            if (street is not None):
-              token = " ".join(split_line[street["start_index"]:prev_end])
-              rest_of_token = " ".join(split_line[street["end_index"]:prev_end])
-              rest_of_token = re.sub(r"(^|\s+)(i|oraz)$", "", rest_of_token)
-              overlapping_streets = prev_end < street["end_index"]
-              prev_end = street["start_index"]
-            
-              if (overlapping_streets):
-                print(f"⚠️ Skipping overlapping street {street} in token {" ".join(split_line)}...")
-                print(f"Found streets: {streets_in_token}.")
-                continue
-
-              parsed_token["street"] = street["street"]
-              parsed_token["is_town"] = False
-              parsed_token["token"] = token
-              parsed_token["except_addresses"] = []
-              is_except = is_except_token
+          if (not is_dash and not ends_with_dash and not starts_with_dash and len(split_by_dash) >= 2):
+            word_from = process_token_word(split_by_dash[0])
+            word_to = process_token_word(split_by_dash[1])
+            if ("num_from" not in parsed_token):
+              parsed_token["num_from"] = get_building_number(word_from)
+            if ("num_to" not in parsed_token):
+              parsed_token["num_to"] = get_building_number(word_to)
+            prev_word = word_from
+            continue
+
+          word = process_token_word(word)
+          if (re.match(all_regex, word)):
+            parsed_token["is_street"] = True
+            break
+
+          if (re.match(odd_regex, word)):
+            parsed_token["is_odd"] = True
+            parsed_token["is_even"] = False
+            set_parity = True
+            if (restored_token and not restored_token["is_odd"]):
+              parsed_tokens.append(restored_token)
+              restored_token = None
+          elif (re.match(even_regex, word)):
+            parsed_token["is_even"] = True
+            parsed_token["is_odd"] = False
+            set_parity = True
+            if (restored_token and not restored_token["is_even"]):
+              parsed_tokens.append(restored_token)
               restored_token = None
 
-              if ("prev_token" in street):
-                prev_token = street["prev_token"]
-                parsed_token["is_even"] = prev_token["is_even"]
-                parsed_token["is_odd"] = prev_token["is_odd"]
-
-              # We found new street, restart token to default settings
-              tmp_token["street"] = street["street"]
-
-              if (len(rest_of_token) == 0):
-                parsed_token["is_street"] = True
-                if (is_except_token and prev_token):
-                  prev_token["except_addresses"].append(parsed_token)
-                elif (prev_token and prev_token["street"] == parsed_token["street"] and prev_token["is_street"]):
-                  # No need to duplicate tokens
-                  continue
-                elif (not is_except_token):
-                  parsed_tokens.append(parsed_token)
-                parsed_token = tmp_token.copy()
-                continue
-              if (re.match(r"bez|oprócz", rest_of_token)):
-                parsed_token["is_street"] = True
-                except_with_street_name = True
-            else:
-              parsed_token["street"] = last_street if last_street != "" else last_town
-              if (not prev_token or prev_token["town"] == parsed_token["town"]):
-                parsed_token["is_even"] = last_is_even
-                parsed_token["is_odd"] = last_is_odd
-              rest_of_token = " ".join(split_line)
-
-            if (parsed_token["street"] in extra_streets_list):
-              continue
-            
-            rest_of_token = re.sub(dash_regex, "-", rest_of_token)
-            rest_of_token = re.sub(r"^/", "", rest_of_token) # See: Olsztyn
-            rest_of_token = re.sub(building_types_regex, "", rest_of_token)
-            rest_of_token = re.sub(r"(\w+)\s+\1", r"\1", rest_of_token)
-            split_token = re.split(r"\s+", rest_of_token.strip())
-            prev_word = ""
-            next_word = ""
-            word_idx = -1
-            skip_token = False
-            set_parity = False
-            
-            if (prev_token and prev_token["street"] == parsed_token["street"] and prev_token["is_street"]):
-              if (not restored_prev_token):
-                parsed_token = parsed_tokens.pop()
-                restored_prev_token = True
+          joined_words = f"{prev_word} {word}"
+          is_start = joined_words == "od początku"
+          is_end = joined_words == "do końca"
+          is_except = is_except or word == "bez" or word == "oprócz"
+          is_num_to = (prev_word == "do" and not is_end) or (prev_is_dash and "num_from" in parsed_token) or starts_with_dash
+
+          if (is_end and "number" in parsed_token):
+            parsed_token["num_from"] = get_building_number(parsed_token["number"])
+            del parsed_token["number"]
+
+          if (is_end and "num_from" in parsed_token and parsed_token["num_from"]["building_n"] == 1 and next_word == "" and not parsed_token["is_even"] and not parsed_token["is_odd"]):
+              parsed_token["is_street"] = True
+
+          if (is_end and set_parity and ((parsed_token["is_even"] and re.match(odd_regex, next_word)) or (parsed_token["is_odd"] and re.match(even_regex, next_word)))):
+            parsed_tokens.append(parsed_token)
+            parsed_token = parsed_token.copy()
+            parsed_token.pop("num_from", None)
+            parsed_token.pop("num_to", None)
+
+          if (is_start or is_end):
+            prev_word = word
+            continue
+
+          if (word == "bez" or word == "oprócz" or (is_except and restored_prev_token)):
+            if (restored_prev_token):
+              parsed_token["is_street"] = True
+            if (restored_prev_token or except_with_street_name or word_idx > 0):
+              parsed_tokens.append(parsed_token)
+              parsed_token = parsed_token.copy()
               parsed_token["is_street"] = False
+              parsed_token["except_addresses"] = []
+              parsed_token.pop("number", None)
+              parsed_token.pop("num_to", None)
+              parsed_token.pop("num_from", None)
+              restored_prev_token = False
+            if (word == "bez" or word == "oprócz"):
+              prev_word = word
+              continue
+          if (re.match(r"(bez|oprócz) numer(u|ów)", joined_words)):
+            continue
 
-            for word in split_token:
-              word_idx += 1
-              next_word = split_token[word_idx + 1] if word_idx < len(split_token) - 1 else ""
-              word = re.sub(r"[():]", "", word)
+          prev_token = parsed_tokens[-1] if len(parsed_tokens) > 0 else None
 
-              if (check_after_parity):
-                prev_token = parsed_tokens[-1]
-                check_after_parity = False
-                if (parsed_token["street"] == prev_token["street"]):
-                  restored_prev_token = True
-                  restored_token = parsed_tokens.pop()
-                  parsed_token = restored_token.copy()
-
-              if (word == "i" or word == "oraz"):
-                if (word_idx > 0 and not is_except):
-                  parsed_tokens.append(parsed_token)
-                elif (word_idx > 0 and is_except):
-                  prev_token = parsed_tokens.pop()
-                  prev_token["except_addresses"].append(parsed_token)
-                  parsed_tokens.append(prev_token)
-                  is_except = next_word != ""
-                if (next_word == ""):
-                  # This token has already been handled, no need to add it later
-                  skip_token = True
-                parsed_token = parsed_token.copy()
-                parsed_token.pop("num_from", None)
-                parsed_token.pop("num_to", None)
-                parsed_token.pop("number", None)
-                prev_word = word
-                set_parity = False
-                continue
-
-              if (word == "wszystkie"):
-                if (not set_parity):
-                  parsed_token["is_odd"] = False
-                  parsed_token["is_even"] = False
-                prev_word = word
-                continue
-
-              if (word == "strona"):
-                prev_word = word
-                continue
-
-              split_by_dash = re.split(dash_regex, word)
-              is_dash = re.match(f"^{dash_regex}$", word)
-              prev_is_dash = re.match(f"^{dash_regex}$", prev_word)
-              ends_with_dash = not is_dash and re.search(f"({dash_regex})$", word) is not None
-              starts_with_dash = not is_dash and re.search(f"^({dash_regex})", word) is not None
-              starts_with_from = word != "od" and word.startswith("od")
-              starts_with_to = word != "do" and word.startswith("do")
-              ends_with_to = word != "do" and word.endswith("do")
-
-              if (ends_with_dash):
-                word = word[:-1]
-                word_idx += 1
-              if (ends_with_to):
-                word = word[:-2]
-                word_idx += 1
-
-              if (starts_with_dash):
-                word = word[1:]
-                prev_word = "-"
-                prev_is_dash = True
-                word_idx += 1
-              if (starts_with_from or starts_with_to):
-                word = word[2:]
-                if (starts_with_from):
-                  prev_word = "od"
-                  word_idx += 1
-                else:
-                  prev_word = "do"
-                  word_idx += 1
-
-              if (not is_dash and not ends_with_dash and not starts_with_dash and len(split_by_dash) >= 2):
-                word_from = process_token_word(split_by_dash[0])
-                word_to = process_token_word(split_by_dash[1])
-                if ("num_from" not in parsed_token):
-                  parsed_token["num_from"] = get_building_number(word_from)
-                if ("num_to" not in parsed_token):
-                  parsed_token["num_to"] = get_building_number(word_to)
-                prev_word = word_from
-                continue
-
-              word = process_token_word(word)
-              if (re.match(all_regex, word)):
-                parsed_token["is_street"] = True
-                break
-
-              if (re.match(odd_regex, word)):
-                parsed_token["is_odd"] = True
-                parsed_token["is_even"] = False
-                set_parity = True
-                if (restored_token and not restored_token["is_odd"]):
-                  parsed_tokens.append(restored_token)
-                  restored_token = None
-              elif (re.match(even_regex, word)):
-                parsed_token["is_even"] = True
+          if (prev_word == "od" and "num_from" in parsed_token):
+            parsed_tokens.append(parsed_token)
+            parsed_token = parsed_token.copy()
+
+          if (is_dash and prev_word != "" and not re.search(even_regex, prev_word)):
+            parsed_token.pop("number", None)
+            parsed_token["num_from"] = get_building_number(prev_word)
+          elif (ends_with_dash):
+            parsed_token["num_from"] = get_building_number(word)
+          elif (prev_word == "od"):
+            parsed_token["num_from"] = get_building_number(word)
+          elif (prev_token is not None and prev_token["street"] == parsed_token["street"] and (prev_token["is_street"] or "num_from" in prev_token) and word_idx == 1 and is_num_to):
+            parsed_token = parsed_tokens.pop()
+            parsed_token["is_street"] = False
+            parsed_token["num_to"] = get_building_number(word)
+          elif (is_num_to):
+            parsed_token["num_to"] = get_building_number(word)
+            if ("number" in parsed_token):
+              num_from = parsed_token["number"]
+              parsed_token["num_from"] = get_building_number(num_from)
+          elif (word != "od" and word != "-" and word != "do" and next_word != "-" and re.match(building_num_regex, word)):
+            parsed_token["number"] = word
+            if (not set_parity):
+              parsed_token["is_even"] = False
+              parsed_token["is_odd"] = False
+            parsed_token["is_street"] = False
+          
+          if (not ends_with_dash and not ends_with_to):
+            prev_word = word
+          else:
+            prev_word = "-"
+
+          if (set_parity and ((parsed_token["is_even"] and re.match(odd_regex, next_word)) or (parsed_token["is_odd"] and re.match(even_regex, next_word)))):
+            parsed_tokens.append(parsed_token)
+            parsed_token = parsed_token.copy()
+            parsed_token.pop("num_from", None)
+            parsed_token.pop("num_to", None)
+
+        num_from = parsed_token.get("num_from")
+        num_to = parsed_token.get("num_to")
+        # Check if building numbers match parity
+        if ((parsed_token["is_even"] or parsed_token["is_odd"]) and (num_from or num_to)):
+          parsed_from = get_parsed_number(num_from)
+          parsed_to = get_parsed_number(num_to)
+          if (parsed_from != -1 or parsed_to != -1):
+            is_odd = parsed_token["is_odd"]
+            if (parsed_token["is_even"]):
+              is_even = True
+              if (parsed_from != -1):
+                is_even = parsed_from % 2 == 0
+              if (is_even and parsed_to != -1):
+                is_even = parsed_to % 2 == 0
+              parsed_token["is_even"] = is_even
+              if (is_even):
                 parsed_token["is_odd"] = False
-                set_parity = True
-                if (restored_token and not restored_token["is_even"]):
-                  parsed_tokens.append(restored_token)
-                  restored_token = None
-
-              joined_words = f"{prev_word} {word}"
-              is_start = joined_words == "od początku"
-              is_end = joined_words == "do końca"
-              is_except = is_except or word == "bez" or word == "oprócz"
-              is_num_to = (prev_word == "do" and not is_end) or (prev_is_dash and "num_from" in parsed_token) or starts_with_dash
-
-              if (is_end and "number" in parsed_token):
-                parsed_token["num_from"] = get_building_number(parsed_token["number"])
-                del parsed_token["number"]
-
-              if (is_end and "num_from" in parsed_token and parsed_token["num_from"]["building_n"] == 1 and next_word == "" and not parsed_token["is_even"] and not parsed_token["is_odd"]):
-                  parsed_token["is_street"] = True
-
-              if (is_end and set_parity and ((parsed_token["is_even"] and re.match(odd_regex, next_word)) or (parsed_token["is_odd"] and re.match(even_regex, next_word)))):
-                parsed_tokens.append(parsed_token)
-                parsed_token = parsed_token.copy()
-                parsed_token.pop("num_from", None)
-                parsed_token.pop("num_to", None)
-
-              if (is_start or is_end):
-                prev_word = word
-                continue
-
-              if (word == "bez" or word == "oprócz" or (is_except and restored_prev_token)):
-                if (restored_prev_token):
-                  parsed_token["is_street"] = True
-                if (restored_prev_token or except_with_street_name or word_idx > 0):
-                  parsed_tokens.append(parsed_token)
-                  parsed_token = parsed_token.copy()
-                  parsed_token["is_street"] = False
-                  parsed_token["except_addresses"] = []
-                  parsed_token.pop("number", None)
-                  parsed_token.pop("num_to", None)
-                  parsed_token.pop("num_from", None)
-                  restored_prev_token = False
-                if (word == "bez" or word == "oprócz"):
-                  prev_word = word
-                  continue
-              if (re.match(r"(bez|oprócz) numer(u|ów)", joined_words)):
-                continue
-
-              prev_token = parsed_tokens[-1] if len(parsed_tokens) > 0 else None
-
-              if (prev_word == "od" and "num_from" in parsed_token):
-                parsed_tokens.append(parsed_token)
-                parsed_token = parsed_token.copy()
-
-              if (is_dash and prev_word != "" and not re.search(even_regex, prev_word)):
-                parsed_token.pop("number", None)
-                parsed_token["num_from"] = get_building_number(prev_word)
-              elif (ends_with_dash):
-                parsed_token["num_from"] = get_building_number(word)
-              elif (prev_word == "od"):
-                parsed_token["num_from"] = get_building_number(word)
-              elif (prev_token is not None and prev_token["street"] == parsed_token["street"] and (prev_token["is_street"] or "num_from" in prev_token) and word_idx == 1 and is_num_to):
-                parsed_token = parsed_tokens.pop()
-                parsed_token["is_street"] = False
-                parsed_token["num_to"] = get_building_number(word)
-              elif (is_num_to):
-                parsed_token["num_to"] = get_building_number(word)
-                if ("number" in parsed_token):
-                  num_from = parsed_token["number"]
-                  parsed_token["num_from"] = get_building_number(num_from)
-              elif (word != "od" and word != "-" and word != "do" and next_word != "-" and re.match(building_num_regex, word)):
-                parsed_token["number"] = word
-                if (not set_parity):
-                  parsed_token["is_even"] = False
-                  parsed_token["is_odd"] = False
-                parsed_token["is_street"] = False
-              
-              if (not ends_with_dash and not ends_with_to):
-                prev_word = word
-              else:
-                prev_word = "-"
-
-              if (set_parity and ((parsed_token["is_even"] and re.match(odd_regex, next_word)) or (parsed_token["is_odd"] and re.match(even_regex, next_word)))):
-                parsed_tokens.append(parsed_token)
-                parsed_token = parsed_token.copy()
-                parsed_token.pop("num_from", None)
-                parsed_token.pop("num_to", None)
-
-            num_from = parsed_token.get("num_from")
-            num_to = parsed_token.get("num_to")
-            # Check if building numbers match parity
-            if ((parsed_token["is_even"] or parsed_token["is_odd"]) and (num_from or num_to)):
-              parsed_from = get_parsed_number(num_from)
-              parsed_to = get_parsed_number(num_to)
-              if (parsed_from != -1 or parsed_to != -1):
-                is_odd = parsed_token["is_odd"]
-                if (parsed_token["is_even"]):
-                  is_even = True
-                  if (parsed_from != -1):
-                    is_even = parsed_from % 2 == 0
-                  if (is_even and parsed_to != -1):
-                    is_even = parsed_to % 2 == 0
-                  parsed_token["is_even"] = is_even
-                  if (is_even):
-                    parsed_token["is_odd"] = False
-                elif (is_odd):
-                  if (parsed_from != -1):
-                    is_odd = parsed_from % 2 == 1
-                  if (is_odd and parsed_to != -1):
-                    is_odd = parsed_to % 2 == 1
-                  parsed_token["is_odd"] = is_odd
-                  if (is_odd):
-                    parsed_token["is_even"] = False
-            
-            last_is_odd = parsed_token["is_odd"]
-            last_is_even = parsed_token["is_even"]
-            if (len(split_token) == 1 and re.search(even_regex, split_token[0])):
-              check_after_parity = True
-            
-            if (not skip_token):
-              if (is_except):
-                prev_token = parsed_tokens.pop()
-                prev_token["except_addresses"].append(parsed_token)
-                parsed_tokens.append(prev_token)
-              else:
-                parsed_tokens.append(parsed_token)
-            restored_token = None
-            parsed_token = tmp_token.copy()
-      
-      for token in parsed_tokens:
-        if (token["token"] == ""):
-          continue
+            elif (is_odd):
+              if (parsed_from != -1):
+                is_odd = parsed_from % 2 == 1
+              if (is_odd and parsed_to != -1):
+                is_odd = parsed_to % 2 == 1
+              parsed_token["is_odd"] = is_odd
+              if (is_odd):
+                parsed_token["is_even"] = False
+        
+        last_is_odd = parsed_token["is_odd"]
+        last_is_even = parsed_token["is_even"]
+        if (len(split_token) == 1 and re.search(even_regex, split_token[0])):
+          check_after_parity = True
+        
+        if (not skip_token):
+          if (is_except):
+            prev_token = parsed_tokens.pop()
+            prev_token["except_addresses"].append(parsed_token)
+            parsed_tokens.append(prev_token)
+          else:
+            parsed_tokens.append(parsed_token)
+        restored_token = None
+        parsed_token = tmp_token.copy()
+
+  return parsed_tokens
+
+def get_district_tokens_to_skip(rules: RuleIndex, teryt: str, number: int):
+  tokens_to_skip = rules["tokens_to_skip"]
+  return tokens_to_skip.get((teryt, number), tokens_to_skip.get((teryt, None), no_tokens_to_skip))
+
+def get_borders_context(teryt: str, teryt_addresses: pandas.DataFrame, teryt_streets: pandas.DataFrame, inputs: MatchInputs) -> BordersContext:
+  teryt_towns = inputs["towns"].get(teryt)
+  all_towns = [ *teryt_towns["town"].to_list(), *teryt_addresses["town"].to_list() ]
+  town_names = set(all_towns)
+
+  tokens_to_replace = inputs["rules"]["tokens_to_replace"].get(teryt, {})
+  # Extra streets have to be parsed but will be discarded anyway
+  extra_streets = inputs["extra_streets"].get(teryt)
+  extra_streets_list = extra_streets["street"].to_list()
+  teryt_streets = concat(teryt_streets, extra_streets)
+  teryt_streets = concat(teryt_streets, teryt_addresses)
+  teryt_streets = teryt_streets.reset_index()
+  teryt_streets = teryt_streets.drop_duplicates(["town", "street"])
+  street_index = get_street_index(teryt_streets)
+
+  return {
+    "teryt": teryt,
+    "town_names": town_names,
+    "street_index": street_index,
+    "extra_streets": extra_streets_list,
+    "tokens_to_replace": tokens_to_replace,
+    "vocabulary_hash": get_vocabulary_hash(town_names, street_index, extra_streets_list),
+  }
 
-        if (token["street"] == token["town"] and not token["is_town"] and not token["is_street"] and "number" not in token and "num_from" not in token and "num_to" not in token):
-          print(f"No street found for token {token}...")
-          continue
+def select_addresses(address_index: AddressIndex, token: ParsedToken, ids_to_ignore: Set[int]) -> List[int]:
+  if (token["token"] == ""):
+    return []
+
+  if (token["street"] == token["town"] and not token["is_town"] and not token["is_street"] and "number" not in token and "num_from" not in token and "num_to" not in token):
+    logger.warning("No street found for token %s...", token)
+    stats["tokens_without_addresses"] += 1
+    return []
+
+  town = token["town"]
+  except_addresses: set[int] = set()
+  for except_token in token["except_addresses"]:
+    except_addresses.update(address_index.get_token_ids(town, except_token).tolist())
+
+  is_whole_street = token["is_street"] and not token["is_even"] and not token["is_odd"]
+  if (token["is_town"]):
+    matched_ids = address_index.get_town_ids(town)
+  elif (is_whole_street):
+    matched_ids = address_index.get_street_ids(town, token["street"])
+  else:
+    matched_ids = address_index.get_token_ids(town, token)
+
+  stats["address_rows_scanned"] += len(matched_ids) + len(except_addresses)
+  matched_ids = [id for id in matched_ids.tolist() if id not in ids_to_ignore and id not in except_addresses]
+  if (len(matched_ids) == 0 and not token["is_town"] and not is_whole_street):
+    logger.warning("No addresses found for token: %s", token)
+    stats["tokens_without_addresses"] += 1
+  return matched_ids
+
+class Assignments(TypedDict):
+  address_id: List[int]
+  token: List[int]
+  district: List[str]
+
+def add_assignments(assignments: Assignments, address_ids: List[int], token_id: int, district_id: str):
+  assignments["address_id"].extend(address_ids)
+  assignments["token"].extend([token_id] * len(address_ids))
+  assignments["district"].extend([district_id] * len(address_ids))
+
+def get_assigned_addresses(addresses: pandas.DataFrame, assignments: pandas.DataFrame, tokens: List[str], geometries: GeometryIndex) -> geo.GeoDataFrame:
+  # Token strings are shared between rows, addresses without a token (special districts) get None
+  token_table = np.array([*tokens, None], dtype=object)
+  assignments = assignments.assign(token=token_table[assignments["token"].to_numpy()])
+  return geometries.attach(addresses.merge(assignments, on="address_id"))
+
+class Voivodeship(TypedDict):
+  teryt: str
+  addresses: Shards
+  streets: Shards
+  geometries: GeometryIndex
+
+# Assigned addresses and tokens of a single gmina
+TerytResult = Tuple[pandas.DataFrame | None, List[str]]
+
+worker_utils: Utils | None = None
+worker_inputs: MatchInputs | None = None
+worker_borders_cache: BordersCache | None = None
+
+def read_rules(path: str):
+  return pandas.read_csv(path, converters={ "teryt": str }, encoding="utf-8", sep=";")
+
+def load_inputs() -> MatchInputs:
+  districts = pandas.read_csv("data_processed/districts.csv", converters={ "teryt": str }, sep="|", encoding="utf-8")
+  # Force special districts to be first
+  districts.loc[districts["borders"].str.contains("Dom Pomocy Społecznej"), "type"] = "dom pomocy społecznej"
+  districts = districts.sort_values("type", key=lambda x: x.map(district_types))
 
-        token_addresses = teryt_addresses[teryt_addresses["town"] == token["town"]]
-        token_addresses = token_addresses[~(token_addresses["f_address"].isin(special_addresses))]
-        token_addresses = token_addresses[~(token_addresses["f_address"].isin(addresses_to_skip))]
-        token_addresses["token"] = json.dumps(token)
-        if (district_addresses is not None):
-          # Ignore duplicate addresses
-          token_addresses = token_addresses[~(token_addresses["f_address"].isin(district_addresses.f_address))]
-
-        except_addresses = []
-        for except_token in token["except_addresses"]:
-          except_addresses.extend(get_addresses_for_token(except_token, token_addresses)["f_address"].to_list())
-
-        if (token["is_town"]):
-          token_addresses = token_addresses[~(token_addresses["f_address"].isin(except_addresses))]
-          district_addresses = concat(district_addresses, token_addresses)
-          continue
+  return {
+    "districts": Shards(districts),
+    "towns": Shards(apply_schema(load_table("data_processed/addresses/prng", columns=["teryt", "town"]), street_schema, ["teryt", "town"])),
+    "rules": get_rule_index(read_rules(tokens_to_skip_path), read_rules("const/tokens_to_replace.csv")),
+    "extra_streets": Shards(read_rules("const/extra_streets.csv")),
+    "addresses_to_skip": Shards(read_rules("const/addresses_to_skip.csv")),
+  }
 
-        token_addresses = token_addresses[token_addresses["street"] == token["street"]]
-        is_even = token["is_even"]
-        is_odd = token["is_odd"]
-        if (token["is_street"] and not is_even and not is_odd):
-          token_addresses = token_addresses[~(token_addresses["f_address"].isin(except_addresses))]
-          district_addresses = concat(district_addresses, token_addresses)
-          continue
+def sort_addresses(addresses: pandas.DataFrame):
+  # For easier duplicates search, stable sort keeps the order the same for any subset of addresses
+  return addresses.sort_values(["town", "street", "building_n", "building_l"], kind="stable")
+
+def load_shared_addresses(teryts: List[str]) -> Tuple[pandas.DataFrame, GeometryIndex]:
+  table = pa.concat_tables([read_arrow(f"{shards_path}/addresses_{teryt}") for teryt in teryts])
+  return sort_addresses(apply_schema(table.select(address_columns).to_pandas(), address_schema)), GeometryIndex(table)
+
+def get_streets_teryt(teryt: str):
+  # Streets in Warsaw are assigned to city-wide TERYT instead of districts
+  return "146501" if teryt.startswith("1465") else teryt
+
+def get_borders_cache():
+  # Parsed tokens depend on the street name rules and on the tokenizer itself
+  return BordersCache(borders_cache_path, f"{matcher_version}:{get_rules_hash()}")
+
+def flush_caches(utils: Utils, borders_cache: BordersCache):
+  if (utils.street_cache is not None):
+    utils.street_cache.flush()
+    utils.street_cache.print_stats()
+  borders_cache.flush()
+  borders_cache.print_stats()
+
+def get_powiat_addresses(addresses: pandas.DataFrame, geometries: GeometryIndex, results: List[TerytResult]):
+  powiat_assignments: List[pandas.DataFrame] = []
+  tokens: List[str] = []
+  for assignments, teryt_tokens in results:
+    if (assignments is None):
+      continue
+    # Token ids are local to each gmina
+    token_ids = assignments["token"].to_numpy()
+    powiat_assignments.append(assignments.assign(token=np.where(token_ids >= 0, token_ids + len(tokens), -1)))
+    tokens.extend(teryt_tokens)
+
+  if (len(powiat_assignments) == 0):
+    return None
+  return get_assigned_addresses(addresses, pandas.concat(powiat_assignments, ignore_index=True), tokens, geometries)
+
+def save_powiat(powiat: str, matched_addresses: geo.GeoDataFrame):
+  save_parquet(f"matched_addresses/{powiat}", remove_categories(matched_addresses))
+
+def init_worker(verbosity: int, json_path: str | None):
+  global worker_utils, worker_inputs, worker_borders_cache
+  setup_diagnostics(verbosity, json_path)
+  print("Loading data...")
+  worker_utils = Utils(street_cache_path=street_cache_path)
+  worker_inputs = load_inputs()
+  worker_borders_cache = get_borders_cache()
+
+def match_teryt(teryt: str) -> TerytResult:
+  utils = cast(Utils, worker_utils)
+  addresses, geometries = load_shared_addresses([teryt])
+  streets = apply_schema(load_arrow(f"{shards_path}/streets_{get_streets_teryt(teryt)}"), street_schema)
+  borders_cache = cast(BordersCache, worker_borders_cache)
+  # Outputs are written while the caches are flushed, failed writes fail the gmina instead of being lost on shutdown
+  with OutputWriter() as writer:
+    result = process_teryt(teryt, addresses, streets, geometries, utils, cast(MatchInputs, worker_inputs), borders_cache, writer)
+    flush_caches(utils, borders_cache)
+  return result
+
+def save_stats(teryt: str):
+  os.makedirs(stats_path, exist_ok=True)
+  with open(f"{stats_path}/{teryt}.json", "w", encoding="utf-8") as file:
+    json.dump({ "teryt": teryt, **{ column: stats[column] for column in [*stats_time_columns, *stats_count_columns] } }, file, indent=2)
+
+def save_stats_report():
+  # Gminas reused in delta mode keep stats from the run which matched them
+  files = sorted(glob.glob(f"{stats_path}/*.json"))
+  if (len(files) == 0):
+    return
+  rows = []
+  for file_name in files:
+    with open(file_name, encoding="utf-8") as file:
+      rows.append(json.load(file))
+  report = pandas.DataFrame(rows).reindex(columns=["teryt", *stats_time_columns, *stats_count_columns]).fillna(0)
+  report[stats_time_columns] = report[stats_time_columns].round(3)
+  report[stats_count_columns] = report[stats_count_columns].astype(int)
+  report = report.sort_values("seconds", ascending=False)
+  report.to_csv(stats_report_path, index=False)
+  print(f"Saved matching stats to {stats_report_path}, the slowest gmina was {report.iloc[0]["teryt"]} ({report.iloc[0]["seconds"]:.1f}s).")
+
+def get_powiats(teryts: Iterable[str]):
+  powiats: Dict[str, List[str]] = {}
+  for teryt in sorted(teryts):
+    powiats.setdefault(teryt[:4], []).append(teryt)
+  return powiats
+
+def hash_rows(df: pandas.DataFrame):
+  return hashlib.sha256(df.to_csv(index=False).encode()).hexdigest()
+
+def get_teryt_inputs(teryt: str, districts: Shards, tokens_to_skip: Shards, data_inputs: Dict[str, str]):
+  inputs = { **data_inputs, "elections": elections, "matcher_version": matcher_version, "normalizer_version": normalizer_version }
+  inputs[f"data_processed/districts.csv:{teryt}"] = hash_rows(districts.get(teryt))
+  # Only rules for the current elections are used, so rules added for other elections don't invalidate results
+  inputs[f"{tokens_to_skip_path}:{teryt}"] = hash_rows(tokens_to_skip.get(teryt))
+  for file in match_rule_files:
+    if (file != tokens_to_skip_path):
+      inputs[f"{file}:{teryt}"] = hash_teryt_rows(file, teryt)
+  return inputs
+
+def get_all_teryt_inputs(powiats: Dict[str, List[str]], districts: Shards):
+  teryt_inputs: Dict[str, Dict[str, str]] = {}
+  tokens_to_skip = Shards(get_election_tokens_to_skip(read_rules(tokens_to_skip_path)))
+  # Code is versioned with matcher_version and normalizer_version, only street name rules are hashed
+  towns_inputs = get_inputs(["data_processed/addresses/prng.parquet", *rule_files])
+  woj_inputs: Dict[str, Dict[str, str]] = {}
+  for powiat, powiat_teryts in powiats.items():
+    woj_teryt = powiat[:2]
+    if (woj_teryt not in woj_inputs):
+      woj_inputs[woj_teryt] = { **towns_inputs, **get_inputs([f"data_processed/addresses/{woj_teryt}.parquet", f"data_processed/streets/{woj_teryt}.parquet"]) }
+    for teryt in powiat_teryts:
+      teryt_inputs[teryt] = get_teryt_inputs(teryt, districts, tokens_to_skip, woj_inputs[woj_teryt])
+  return teryt_inputs
+
+def load_previous_results(powiat: str, teryts: List[str]):
+  previous = Shards(pandas.read_parquet(f"matched_addresses/{powiat}.parquet", columns=["teryt", "address_id", "token", "district"]))
+  results: Dict[str, TerytResult] = {}
+  for teryt in teryts:
+    teryt_previous = previous.get(teryt)
+    if (len(teryt_previous) == 0):
+      results[teryt] = (None, [])
+      continue
+    token_ids, tokens = pandas.factorize(teryt_previous["token"])
+    assignments = pandas.DataFrame({ "address_id": teryt_previous["address_id"].to_numpy(), "token": token_ids, "district": teryt_previous["district"].to_numpy() })
+    results[teryt] = (assignments, list(tokens))
+  return results
+
+def main(jobs: int = 1, delta: bool = False, verbosity: int = 0, json_path: str | None = None, lookahead: int = default_lookahead):
+  print("Loading data...")
+  for path in [error_log_path, json_path]:
+    if (path is not None and os.path.isfile(path)):
+      os.remove(path)
+  setup_diagnostics(verbosity, json_path)
+
+  inputs = load_inputs()
+  powiats = get_powiats(inputs["districts"].keys())
+  manifest = load_manifest(manifest_path) if delta else {}
+  teryt_inputs = get_all_teryt_inputs(powiats, inputs["districts"])
+  # Gminas which haven't changed since the previous run reuse its results
+  previous_results: Dict[str, TerytResult] = {}
+  powiats_to_match: Dict[str, List[str]] = {}
+  for powiat, powiat_teryts in powiats.items():
+    outputs = [f"matched_addresses/{powiat}.parquet"]
+    unchanged_teryts = [teryt for teryt in powiat_teryts if is_up_to_date(manifest, teryt, teryt_inputs[teryt], outputs)]
+    if (len(unchanged_teryts) == len(powiat_teryts)):
+      print(f"Powiat {powiat} is up to date!")
+      continue
+    if (len(unchanged_teryts) > 0):
+      print(f"Reusing results for {len(unchanged_teryts)} out of {len(powiat_teryts)} gminas in powiat {powiat}...")
+      previous_results.update(load_previous_results(powiat, unchanged_teryts))
+    powiats_to_match[powiat] = powiat_teryts
+
+  def save_powiat_outputs(powiat: str, matched_addresses: geo.GeoDataFrame):
+    save_powiat(powiat, matched_addresses)
+    # Manifest is only updated once the results are on disk
+    for teryt in powiats[powiat]:
+      manifest[teryt] = teryt_inputs[teryt]
+    save_manifest(manifest_path, manifest)
+
+  woj_teryts = sorted(set([powiat[:2] for powiat in powiats_to_match]))
+  with OutputWriter() as writer:
+    def on_powiat_matched(powiat: str, matched_addresses: geo.GeoDataFrame | None):
+      # Checked before submitting, so that the error is raised where the powiat was matched
+      if (matched_addresses is None):
+        raise ValueError(f"No addresses matched found for powiat {powiat}!")
+      writer.submit(f"matched addresses for powiat {powiat}", save_powiat_outputs, powiat, matched_addresses)
+
+    if (jobs > 1):
+      match_parallel(woj_teryts, powiats_to_match, previous_results, jobs, on_powiat_matched, (verbosity, json_path))
+    else:
+      match_sequential(woj_teryts, powiats_to_match, previous_results, inputs, on_powiat_matched, writer, lookahead)
+  save_stats_report()
+
+def load_voivodeship(woj_teryt: str) -> Voivodeship:
+  print(f"Loading data for voivodeship {woj_teryt}...")
+  addresses = sort_addresses(apply_schema(load_table(f"data_processed/addresses/{woj_teryt}", columns=address_columns), address_schema))
+  streets = apply_schema(load_table(f"data_processed/streets/{woj_teryt}", columns=street_columns), street_schema)
+  return {
+    "teryt": woj_teryt,
+    "addresses": Shards(addresses),
+    "streets": Shards(streets),
+    "geometries": load_geometry_index(f"data_processed/addresses/{woj_teryt}"),
+  }
 
-        all_token_addresses = get_addresses_for_token(token, token_addresses)
-        token_addresses = all_token_addresses[~(all_token_addresses["f_address"].isin(except_addresses))]
-          
-        if (len(token_addresses) == 0):
-          print("No addresses found for token:", token)
-        else:
-          district_addresses = concat(district_addresses, token_addresses)
+def match_sequential(
+    woj_teryts: List[str],
+    powiats: Dict[str, List[str]],
+    previous_results: Dict[str, TerytResult],
+    inputs: MatchInputs,
+    on_powiat_matched: Callable[[str, geo.GeoDataFrame | None], None],
+    writer: OutputWriter | None = None,
+    lookahead: int = default_lookahead,
+  ):
+  utils = Utils(street_cache_path=street_cache_path)
+  borders_cache = get_borders_cache()
+  # Next voivodeship is read and sorted while the current one is being matched
+  for voivodeship in prefetch(woj_teryts, load_voivodeship, lookahead):
+    for powiat, powiat_teryts in powiats.items():
+      if (not powiat.startswith(voivodeship["teryt"])):
+        continue
+      on_powiat_matched(powiat, process_powiat(powiat_teryts, voivodeship["addresses"], voivodeship["streets"], voivodeship["geometries"], utils, inputs, borders_cache, previous_results, writer))
+      flush_caches(utils, borders_cache)
+
+def match_parallel(
+    woj_teryts: List[str],
+    powiats: Dict[str, List[str]],
+    previous_results: Dict[str, TerytResult],
+    jobs: int,
+    on_powiat_matched: Callable[[str, geo.GeoDataFrame | None], None],
+    diagnostics_args: Tuple[int, str | None] = (0, None),
+  ):
+  os.makedirs(shards_path, exist_ok=True)
+  address_counts: Dict[str, int] = {}
+  for woj_teryt in woj_teryts:
+    print(f"Sharing data for voivodeship {woj_teryt}...")
+    # Every gmina is saved to a separate file, so that workers only read their own addresses
+    woj_teryts_to_save = [teryt for powiat, powiat_teryts in powiats.items() if powiat.startswith(woj_teryt) for teryt in powiat_teryts]
+    addresses = save_arrow_shards(f"{shards_path}/addresses", f"data_processed/addresses/{woj_teryt}", woj_teryts_to_save, [*address_columns, "geometry"])
+    save_arrow_shards(f"{shards_path}/streets", f"data_processed/streets/{woj_teryt}", sorted(set(map(get_streets_teryt, woj_teryts_to_save))), street_columns)
+    for count in pc.value_counts(addresses["teryt"]).to_pylist():
+      address_counts[count["values"]] = count["counts"]
+
+  results: Dict[str, TerytResult] = dict(previous_results)
+  teryts = [teryt for powiat_teryts in powiats.values() for teryt in powiat_teryts if teryt not in results]
+  # Start with the biggest gminas so that they don't end up running alone at the end
+  teryts = sorted(teryts, key=lambda teryt: address_counts.get(teryt, 0), reverse=True)
+  print(f"Matching {len(teryts)} gminas using {jobs} processes...")
+  with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=diagnostics_args) as executor:
+    futures = { executor.submit(match_teryt, teryt): teryt for teryt in teryts }
+    for future in as_completed(futures):
+      teryt = futures[future]
+      results[teryt] = future.result()
+      powiat_teryts = powiats[teryt[:4]]
+      if (all(powiat_teryt in results for powiat_teryt in powiat_teryts)):
+        # Gminas are combined in TERYT order, so the output doesn't depend on the order in which they finished
+        addresses, geometries = load_shared_addresses(powiat_teryts)
+        on_powiat_matched(teryt[:4], get_powiat_addresses(addresses, geometries, [results.pop(powiat_teryt) for powiat_teryt in powiat_teryts]))
 
-      if (district_addresses is not None):
-        district_addresses["district"] = district_id
-        addresses_out = concat(addresses_out, district_addresses)
+def process_powiat(
+    teryts: List[str],
+    address_shards: Shards,
+    street_shards: Shards,
+    geometries: GeometryIndex,
+    utils: Utils,
+    inputs: MatchInputs,
+    borders_cache: BordersCache | None = None,
+    previous_results: Dict[str, TerytResult] | None = None,
+    writer: OutputWriter | None = None,
+  ):
+  previous_results = previous_results if previous_results is not None else {}
+  results = [previous_results[teryt] if teryt in previous_results else process_teryt(teryt, address_shards.get(teryt), street_shards.get(get_streets_teryt(teryt)), geometries, utils, inputs, borders_cache, writer) for teryt in teryts]
+  addresses = sort_addresses(pandas.concat([address_shards.get(teryt) for teryt in teryts]))
+  return get_powiat_addresses(addresses, geometries, results)
+
+def process_teryt(
+    teryt: str,
+    teryt_addresses: pandas.DataFrame,
+    teryt_streets: pandas.DataFrame,
+    geometries: GeometryIndex,
+    utils: Utils,
+    inputs: MatchInputs,
+    borders_cache: BordersCache | None = None,
+    writer: OutputWriter | None = None,
+  ) -> TerytResult:
+  # Parsed token -> token id, each token is serialized only once
+  token_ids: Dict[str, int] = {}
+
+  print(f"Processing {teryt}...")
+  teryt_filter.teryt = teryt
+  stats.clear()
+  start = time.perf_counter()
+  teryt_districts = inputs["districts"].get(teryt)
+  # Addresses are compared using their integer ids, full addresses are only used to look them up
+  address_ids = dict(zip(teryt_addresses["f_address"], teryt_addresses["address_id"]))
+  addresses_to_skip = get_address_ids(address_ids, inputs["addresses_to_skip"].get(teryt)["f_address"])
+  address_index = AddressIndex(teryt_addresses)
+  context = get_borders_context(teryt, teryt_addresses, teryt_streets, inputs)
+  stats["setup_seconds"] += time.perf_counter() - start
+  assignments: Assignments = { "address_id": [], "token": [], "district": [] }
+  processed_rows = 0
+  special_addresses: set[int] = set()
+  for i, district in teryt_districts.iterrows():
+    if (processed_rows != 0 and processed_rows % 10 == 0):
+      print(f"Processed {processed_rows} out of {len(teryt_districts)} districts...")
+
+    district_id = f"{teryt}_{district.number}"
+    district_tokens_to_skip = get_district_tokens_to_skip(inputs["rules"], teryt, district.number)
+    if (district.type != "stały"):
+      district_address_id = address_ids.get(district.f_address, -1)
+      special_addresses.add(district_address_id)
+      if (len(teryt_districts) == 0):
+        # TODO: Attempt geocoding address using API
+        pass
+      if (district_address_id != -1):
+        add_assignments(assignments, [district_address_id], -1, district_id)
       processed_rows += 1
+      continue
+    
+    phase_start = time.perf_counter()
+    parsed_tokens = get_parsed_tokens(context, district, district_tokens_to_skip, utils, borders_cache)
+    stats["tokenizing_seconds"] += time.perf_counter() - phase_start
+    stats["tokens"] += len(parsed_tokens)
+
+    phase_start = time.perf_counter()
+    # Addresses matched in this district are added as they're assigned instead of rebuilding the set for every token
+    ids_to_ignore = special_addresses | addresses_to_skip
+    for token in parsed_tokens:
+      # Ignore duplicate addresses
+      matched_ids = select_addresses(address_index, token, ids_to_ignore)
+      if (len(matched_ids) > 0):
+        token_id = token_ids.setdefault(json.dumps(token), len(token_ids))
+        add_assignments(assignments, matched_ids, token_id, district_id)
+        ids_to_ignore.update(matched_ids)
+    stats["address_selection_seconds"] += time.perf_counter() - phase_start
+
+    processed_rows += 1
+
+  phase_start = time.perf_counter()
+  result: TerytResult = (None, [])
+  if (len(assignments["address_id"]) > 0):
+    teryt_assignments = pandas.DataFrame(assignments)
+    duplicates = teryt_assignments.duplicated(subset=["address_id"], keep=False)
+    assignments_to_save = teryt_assignments[~duplicates]
+    print(f"Found district for {len(assignments_to_save)} out of {len(teryt_addresses)} addresses.")
+    tokens = list(token_ids)
+    if (DEBUG):
+      duplicated = get_assigned_addresses(teryt_addresses, teryt_assignments[duplicates], tokens, geometries)
+      write_output(writer, f"duplicated addresses for {teryt}", save_geojson, f"matched_addresses/duplicated_{teryt}.json", duplicated)
+      no_district = geometries.attach(teryt_addresses[~(teryt_addresses["address_id"].isin(teryt_assignments["address_id"]))])
+      write_output(writer, f"addresses without district for {teryt}", save_geojson, f"matched_addresses/no_district_{teryt}.json", no_district)
+    stats["matched_addresses"] = len(assignments_to_save)
+    result = (assignments_to_save, tokens)
+  stats["output_seconds"] += time.perf_counter() - phase_start
+
+  stats["districts"] = len(teryt_districts)
+  stats["addresses"] = len(teryt_addresses)
+  stats["seconds"] = time.perf_counter() - start
+  save_stats(teryt)
+  flush_diagnostics()
+  return result
 
-    if (addresses_out is not None):
-      duplicates = addresses_out.duplicated(subset=["f_address"], keep=False)
-      addresses_to_save = addresses_out[~duplicates]
-      print(f"Found district for {len(addresses_to_save)} out of {len(teryt_addresses)} addresses.")
-      powiat_addresses = concat(powiat_addresses, addresses_to_save)
-      if (DEBUG):
-        duplicated = addresses_out[duplicates]
-        duplicated.to_file(f"matched_addresses/duplicated_{teryt}.json", driver="GeoJSON")
-        no_district = teryt_addresses[~(teryt_addresses["f_address"].isin(addresses_out.f_address))]
-        no_district.to_file(f"matched_addresses/no_district_{teryt}.json", driver="GeoJSON")
-
-  return powiat_addresses
 if (__name__ == "__main__"): 
-  main()
\ No newline at end of file
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--jobs", type=int, default=1, help="Number of gminas matched in parallel")
+  parser.add_argument("--delta", action="store_true", help="Only rematch gminas whose districts, rules or data changed since the previous run")
+  parser.add_argument("-v", "--verbose", action="count", default=0, help="Show warnings about unmatched tokens, repeat to also show every skipped and replaced token")
+  parser.add_argument("--log-json", help="Write diagnostics to this file as JSON lines instead of printing them")
+  parser.add_argument("--prefetch", type=int, default=default_lookahead, help="Number of voivodeships loaded in the background while matching, 0 disables prefetching")
+  args = parser.parse_args()
+  main(args.jobs, args.delta, args.verbose, args.log_json, args.prefetch)
\ No newline at end of file
@@ -1,37 +1,25 @@
 import pandas as pd
 import geopandas as geo
 import numpy as np
-from utils import load_replacements, load_replacements_exceptions, load_street_prefixes, capitalize_every_word, save_zip, concat, Utils, get_building_order
-from const import districts_columns, addresses_columns, streets_columns, towns_columns, building_num_regex, building_letter_regex, ordinal_regex, year_regex, quotation_regex, multiple_number_regex, dash_regex, apostrophe_regex
+import shapely
+import pyogrio
+from utils import global_rule_files, teryt_rule_files, rule_files, normalizer_version, hash_teryt_rows, get_inputs, is_up_to_date, load_manifest, save_manifest, whitespace_pattern, capitalize_every_word, save_parquet, GeoParquetWriter, OutputWriter, apply_schema, address_schema, concat, Utils, parse_building_numbers, get_unique_rows
+from const import districts_columns, addresses_columns, streets_columns, towns_columns, ordinal_regex, year_regex, quotation_regex, multiple_number_regex, dash_regex, apostrophe_regex
 from typing import TypeVar, cast
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import argparse
 import os
 import os.path as path
 import re
 
 T = TypeVar("T", pd.DataFrame, geo.GeoDataFrame)
 
-def get_building_number(row: pd.Series):
-  match = re.search(building_num_regex, row["building"])
-  if (match):
-    return match.group(2)
-  return ""
-
-def get_building_letter(row: pd.Series):
-  match = re.search(building_letter_regex, row["building"])
-  if (match):
-    return match.group(1)
-  return ""
-
-def handle_replacements(row: pd.Series, replacements: dict[str, str]):  
-  street = row.street
-  for search in replacements:
-    street = re.sub(search, replacements[search], street, flags=re.IGNORECASE)
-    street = re.sub(r"\s+", " ", street)
+def handle_replacements(street: str, replacements: list[tuple[re.Pattern[str], str]]):
+  for search, replacement in replacements:
+    street = search.sub(replacement, street)
+    street = whitespace_pattern.sub(" ", street)
   return street
 
-def handle_name_replacements(row: pd.Series, utils: Utils):
-  return utils.remove_first_name(row.street)
-
 def add_street_type(row: pd.Series):
   if (re.match(r"^Rynek", row.street, flags=re.IGNORECASE)):
     return row.street
@@ -44,31 +32,73 @@ def add_street_type(row: pd.Series):
   
   return row.street
 
-def process_addresses(df: T, column_names: dict[str, str], utils: Utils, is_addresses: bool = False) -> T:
-  print("Normalizing town names...")
-  df["town"] = df["town"].map(capitalize_every_word)
-  # Fill empty street names
-  print("Filling empty street names...")
-  df["street"] = np.where(df["street"].isna(), df["town"], df["street"])
+gminy_cache: dict[str, geo.GeoDataFrame] = {}
+grid_size = 256
+
+def load_gminy(crs) -> geo.GeoDataFrame:
+  key = str(crs)
+  if (key not in gminy_cache):
+    gminy = geo.read_file("data_in/gminy_dzielnice.json", columns=["teryt"])
+    gminy.crs = "EPSG:3857"
+    gminy_cache[key] = gminy.to_crs(crs)
+  return gminy_cache[key]
 
+def get_gminy_within(points: geo.GeoSeries, gminy: geo.GeoDataFrame):
+  minx, miny, maxx, maxy = points.total_bounds
+  gminy = gminy.iloc[gminy.sindex.query(shapely.box(minx, miny, maxx, maxy))]
+  geometries = gminy.geometry.to_numpy()
+  shapely.prepare(geometries)
+  tree = shapely.STRtree(geometries)
+  point_geometries = points.to_numpy()
+
+  # Split the bounding box into a grid and find cells which lie inside of exactly one gmina,
+  # points in those cells don't need to be checked against gmina boundaries
+  cell_width = (maxx - minx) / grid_size or 1
+  cell_height = (maxy - miny) / grid_size or 1
+  cell_x, cell_y = np.meshgrid(minx + np.arange(grid_size) * cell_width, miny + np.arange(grid_size) * cell_height)
+  cell_x, cell_y = cell_x.ravel(), cell_y.ravel()
+  margin = min(cell_width, cell_height) / 1000
+  cells = shapely.box(cell_x - margin, cell_y - margin, cell_x + cell_width + margin, cell_y + cell_height + margin)
+  cell_idx, gmina_idx = tree.query(cells, predicate="intersects")
+  single_gmina = np.bincount(cell_idx, minlength=len(cells))[cell_idx] == 1
+  cell_idx, gmina_idx = cell_idx[single_gmina], gmina_idx[single_gmina]
+  inside = shapely.contains_properly(geometries[gmina_idx], cells[cell_idx])
+  cell_gminas = np.full(len(cells), -1)
+  cell_gminas[cell_idx[inside]] = gmina_idx[inside]
+
+  x = shapely.get_x(point_geometries)
+  y = shapely.get_y(point_geometries)
+  has_coords = np.isfinite(x) & np.isfinite(y)
+  columns = np.clip(np.floor((np.nan_to_num(x) - minx) / cell_width), 0, grid_size - 1).astype(np.int64)
+  rows = np.clip(np.floor((np.nan_to_num(y) - miny) / cell_height), 0, grid_size - 1).astype(np.int64)
+  point_gminas = np.where(has_coords, cell_gminas[rows * grid_size + columns], -1)
+  fast_points = np.flatnonzero(point_gminas >= 0)
+  slow_points = np.flatnonzero(point_gminas < 0)
+  print(f"{len(fast_points)} out of {len(point_geometries)} addresses lie inside of a single gmina.")
+
+  slow_idx, slow_gminas = tree.query(point_geometries[slow_points], predicate="within")
+  point_idx = np.concatenate([fast_points, slow_points[slow_idx]])
+  gmina_idx = np.concatenate([point_gminas[fast_points], slow_gminas])
+  order = np.argsort(point_idx, kind="stable")
+  return point_idx[order], gminy["teryt"].to_numpy()[gmina_idx[order]]
+
+def normalize_streets(df: pd.DataFrame, utils: Utils):
   print("Removing prefixes...")
-  street_prefixes = load_street_prefixes()
-  for search in street_prefixes:
-    df["street"] = df["street"].str.replace(search, street_prefixes[search], regex=True, flags=re.IGNORECASE)
+  for search, replacement in utils.prefix_patterns:
+    df["street"] = df["street"].str.replace(search, replacement, regex=True)
   df["street"] = df["street"].str.replace(utils.duplicate_prefixes_regex, r"\1", regex=True, flags=re.IGNORECASE)
   print("Removed prefixes!")
 
   # Normalize street names
   print("Normalizing street names...")
-  replacements = load_replacements()
-  exceptions = load_replacements_exceptions()
-  except_addresses = df.merge(exceptions, on=["teryt", "street"], how="inner")
-  df = df.merge(exceptions, on=["teryt", "street"], how="left", indicator=True).query("_merge == 'left_only'").drop("_merge", axis=1)
-  df["street"] = df.apply(lambda row: handle_replacements(row, replacements), axis=1)
+  replacements = utils.replacement_patterns
+  exceptions = utils.replacements_exceptions
+  is_exception = pd.MultiIndex.from_frame(df[["teryt", "street"]]).isin(pd.MultiIndex.from_frame(exceptions[["teryt", "street"]]))
+  replaced = df["street"].map(lambda street: handle_replacements(street, replacements))
   print("Replaced values in street names!")
   print("Removing names from street names...")
-  df["street"] = df.apply(lambda row: handle_name_replacements(row, utils), axis=1)
-  df = cast(T, pd.concat([df, except_addresses]))
+  replaced = replaced.map(utils.remove_first_name)
+  df["street"] = df["street"].where(is_exception, replaced)
   df["street"] = df["street"].apply(utils.remove_first_letter)
   print("Removed names from street names!")
   # Remove duplicate tokens
@@ -98,9 +128,27 @@ def process_addresses(df: T, column_names: dict[str, str], utils: Utils, is_addr
   # Remove redundant spaces
   print("Removing redundant spaces...")
   df["street"] = df["street"].str.strip().replace(r"\s+", " ", regex=True)
+  return df
 
+def process_addresses(df: T, column_names: dict[str, str], utils: Utils) -> T:
+  # Every name is normalized once per distinct value and then broadcast back to all rows
   print("Normalizing town names...")
-  df["town"] = df.apply(utils.replace_town_name, axis=1)
+  towns, town_codes = get_unique_rows(df, ["town"])
+  df["town"] = towns["town"].map(capitalize_every_word).to_numpy()[town_codes]
+  # Fill empty street names
+  print("Filling empty street names...")
+  df["street"] = np.where(df["street"].isna(), df["town"], df["street"])
+
+  street_columns = ["teryt", "street", "str_type"] if "str_type" in df else ["teryt", "street"]
+  streets, street_codes = get_unique_rows(df, street_columns)
+  print(f"Found {len(streets)} unique street names in {len(df)} rows.")
+  streets = normalize_streets(streets, utils)
+  for column in ["street", "no_type", "no_repl", "no_rep_typ"]:
+    df[column] = streets[column].to_numpy()[street_codes]
+
+  print("Normalizing town names...")
+  towns, town_codes = get_unique_rows(df, ["teryt", "town"])
+  df["town"] = towns.apply(utils.replace_town_name, axis=1).to_numpy()[town_codes]
 
   has_building_numbers = "building" in df
   if (has_building_numbers):
@@ -124,76 +172,166 @@ def process_addresses(df: T, column_names: dict[str, str], utils: Utils, is_addr
     # Remove block number
     df["building"] = df["building"].str.replace(r"(bl\.?|blok)\s+(\d+\w*)$", r"\2", regex=True)
     df["building"] = df["building"].str.replace(r"(\d+)\s*(bl|m)\.?\s*.+$", lambda m: f"{m.group(1)}", regex=True)
-    # Split building numbers into parts
-    df["building_n"] = df.apply(get_building_number, axis=1)
-    df["building_l"] = df.apply(get_building_letter, axis=1)
-    # Assign building order
-    df["building_o"] = df.apply(lambda row: get_building_order(row["building_n"], row["building_l"]), axis=1)
+    # Split building numbers into parts and assign building order
+    building_n, building_l, building_o, building_p = parse_building_numbers(df["building"])
+    df["building_n"] = building_n
+    df["building_l"] = building_l
+    df["building_o"] = building_o
+    df["building_p"] = building_p
 
   if (has_building_numbers and isinstance(df, geo.GeoDataFrame)):
     print("Updating TERYT based on spatial data...")
-    gminy = geo.read_file("data_in/gminy_dzielnice.json")
-    gminy.crs = "EPSG:3857"
-    gminy = gminy.to_crs(df.crs)
-    df = df.sjoin(gminy, predicate="within")
-    df = df.rename(columns={ "teryt_right": "teryt" })
-    df = df[[*[column_names[key] for key in column_names], *["building_n", "building_l", "building_o", "no_type", "no_repl", "no_rep_typ"]]]
+    point_idx, teryts = get_gminy_within(df.geometry, load_gminy(df.crs))
+    df = df.iloc[point_idx]
+    df["teryt"] = teryts
+    df = df[[*[column_names[key] for key in column_names], *["building_n", "building_l", "building_o", "building_p", "no_type", "no_repl", "no_rep_typ"]]]
 
   if (has_building_numbers):
     df["f_address"] = df[["teryt", "town", "street", "building"]].agg(" ".join, axis=1)
-  if (is_addresses):
-    df = df.drop_duplicates(subset=["f_address"])
   return df
 
-def process_data():
+addresses_path = "data_processed/addresses"
+streets_path = "data_processed/streets"
+manifest_path = "data_processed/manifest.json"
+# Names are normalized by utils.py, which is versioned instead of hashed as it's mostly matching code
+source_files = ["process_data.py", "const.py"]
+worker_utils: Utils | None = None
+default_batch_size = 500000
+address_ids_per_voivodeship = pow(10, 9)
+
+def get_voivodeship_inputs(teryt: str):
+  inputs = get_inputs([f"data_in/addresses/{teryt}.zip", "data_in/gminy_dzielnice.json", *global_rule_files, *source_files])
+  inputs["normalizer_version"] = normalizer_version
+  for file in teryt_rule_files:
+    inputs[f"{file}:{teryt}"] = hash_teryt_rows(file, teryt)
+  return inputs
+
+def init_worker():
+  global worker_utils
+  print("Loading utils...")
+  worker_utils = Utils()
+
+def process_voivodeship(teryt: str, utils: Utils | None = None, batch_size: int = default_batch_size):
+  utils = utils if utils is not None else cast(Utils, worker_utils)
+  print(f"Loading streets for voivodeship {teryt}...")
+  streets = geo.read_file(f"data_in/addresses/{teryt}.zip!PRG_Ulice_{teryt}.shp")
+  squares = geo.read_file(f"data_in/addresses/{teryt}.zip!PRG_Place_{teryt}.shp")
+  streets = concat(streets, squares)
+  streets = streets[[key for key in streets_columns]].rename(columns=streets_columns)
+  print(f"Processing streets for voivodeship {teryt}...")
+  streets = process_addresses(streets, streets_columns, utils)
+  writer = GeoParquetWriter(f"{addresses_path}/{teryt}")
+  try:
+    # Outputs are written in the background while the next batch of addresses is processed,
+    # at most one batch waits in the queue so that no more than three batches are held in memory
+    with OutputWriter(max_pending=1) as output_writer:
+      output_writer.submit(f"streets for voivodeship {teryt}", save_parquet, f"{streets_path}/{teryt}", streets)
+
+      streets = streets.drop_duplicates(subset=["teryt", "str_type", "ULIC_id"])
+      streets = streets[["str_type", "ULIC_id", "teryt"]]
+      columns = { key: addresses_columns[key] for key in addresses_columns if key != "Cecha" }
+      addresses_file = f"data_in/addresses/{teryt}.zip!PRG_PunktyAdresowe_{teryt}.shp"
+      total_addresses = pyogrio.read_info(addresses_file)["features"]
+      # Duplicates are removed across batches, the first occurrence of every address is kept.
+      # Only sorted 64-bit hashes of the addresses are kept instead of the strings themselves
+      seen_addresses = np.empty(0, dtype=np.uint64)
+      processed_rows = 0
+      for skip in range(0, total_addresses, batch_size):
+        print(f"Loading addresses {skip + 1}-{min(skip + batch_size, total_addresses)} out of {total_addresses} for voivodeship {teryt}...")
+        addresses = geo.read_file(addresses_file, skip_features=skip, max_features=batch_size)
+        addresses = addresses.merge(streets, left_on=["TERYT", "ULIC_id"], right_on=["teryt", "ULIC_id"], how="left")
+        addresses = addresses[[*[key for key in columns], "str_type"]].rename(columns=columns)
+        print(f"Processing data for voivodeship {teryt}...")
+        addresses = process_addresses(addresses, columns, utils)
+        addresses = addresses.drop_duplicates(subset=["f_address"])
+        hashes = pd.util.hash_pandas_object(addresses["f_address"], index=False).to_numpy()
+        is_new = ~np.isin(hashes, seen_addresses)
+        addresses = addresses[is_new]
+        seen_addresses = np.union1d(seen_addresses, hashes[is_new])
+        # Addresses are identified by a stable integer instead of the full address string
+        addresses["address_id"] = int(teryt) * address_ids_per_voivodeship + np.arange(processed_rows, processed_rows + len(addresses), dtype=np.int64)
+        processed_rows += len(addresses)
+        # Text columns are dictionary encoded by parquet anyway, so only numbers are converted here
+        addresses = apply_schema(addresses, address_schema, compact_strings=False)
+        output_writer.submit(f"addresses {skip + 1}-{min(skip + batch_size, total_addresses)} for voivodeship {teryt}", writer.write, addresses)
+      output_writer.submit(f"addresses for voivodeship {teryt}", writer.close)
+  except:
+    # Output writer has finished by now, so the partially written file can be removed
+    writer.abort()
+    raise
+  print(f"Saved {writer.rows} addresses for voivodeship {teryt}!")
+  return teryt
+
+def process_data(jobs: int = 1, force: bool = False, batch_size: int = default_batch_size):
+  manifest = {} if force else load_manifest(manifest_path)
   print("Loading utils...")
   utils = Utils()
-  print("Loading voting districts...")
-  districts = pd.read_excel("data_in/districts.xlsx", converters={ "TERYT gminy": str })
-  districts = districts[[key for key in districts_columns]].rename(columns=districts_columns)
-  districts = districts[~districts["teryt"].isna()]
-  print("Processing districts...")
-  districts = process_addresses(districts, districts_columns, utils)
-  districts.to_csv("data_processed/districts.csv", index=False, sep="|", encoding="utf-8")
-  print("Address points saved!")
+  districts_inputs = { **get_inputs(["data_in/districts.xlsx", *rule_files, *source_files]), "normalizer_version": normalizer_version }
+  if (is_up_to_date(manifest, "districts", districts_inputs, ["data_processed/districts.csv"])):
+    print("Voting districts are up to date!")
+  else:
+    print("Loading voting districts...")
+    districts = pd.read_excel("data_in/districts.xlsx", converters={ "TERYT gminy": str })
+    districts = districts[[key for key in districts_columns]].rename(columns=districts_columns)
+    districts = districts[~districts["teryt"].isna()]
+    print("Processing districts...")
+    districts = process_addresses(districts, districts_columns, utils)
+    districts.to_csv("data_processed/districts.csv", index=False, sep="|", encoding="utf-8")
+    manifest["districts"] = districts_inputs
+    save_manifest(manifest_path, manifest)
+    print("Address points saved!")
 
   print("Loading address points...")
-  addresses_path = "data_processed/addresses"
   if (not path.exists(addresses_path)):
       os.mkdir(addresses_path)
-  streets_path = "data_processed/streets"
   if (not path.exists(streets_path)):
       os.mkdir(streets_path)
 
+  woj_teryts = []
+  woj_inputs: dict[str, dict[str, str]] = {}
   for i in range(16):
-    teryt = str((i + 1) * 2)
-    teryt = teryt.rjust(2, "0")
-    print(f"Loading streets for voivodeship {teryt}...")
-    streets = geo.read_file(f"data_in/addresses/{teryt}.zip!PRG_Ulice_{teryt}.shp")
-    squares = geo.read_file(f"data_in/addresses/{teryt}.zip!PRG_Place_{teryt}.shp")
-    streets = concat(streets, squares)
-    streets = streets[[key for key in streets_columns]].rename(columns=streets_columns)
-    print(f"Processing streets for voivodeship {teryt}...")
-    streets = process_addresses(streets, streets_columns, utils, False)
-    save_zip(f"{streets_path}/{teryt}", streets)
-
-    print(f"Loading data for voivodeship {teryt}...")
-    addresses = geo.read_file(f"data_in/addresses/{teryt}.zip!PRG_PunktyAdresowe_{teryt}.shp")
-    streets = streets.drop_duplicates(subset=["teryt", "str_type", "ULIC_id"])
-    streets = streets[["str_type", "ULIC_id", "teryt"]]
-    addresses = addresses.merge(streets, left_on=["TERYT", "ULIC_id"], right_on=["teryt", "ULIC_id"], how="left")
-    del addresses_columns["Cecha"]
-    addresses = addresses[[*[key for key in addresses_columns], "str_type"]].rename(columns=addresses_columns)
-    print(f"Processing data for voivodeship {teryt}...")
-    addresses = process_addresses(addresses, addresses_columns, utils, True)
-    save_zip(f"{addresses_path}/{teryt}", addresses)
+    teryt = str((i + 1) * 2).rjust(2, "0")
+    woj_inputs[teryt] = get_voivodeship_inputs(teryt)
+    if (is_up_to_date(manifest, teryt, woj_inputs[teryt], [f"{streets_path}/{teryt}.parquet", f"{addresses_path}/{teryt}.parquet"])):
+      print(f"Voivodeship {teryt} is up to date!")
+    else:
+      woj_teryts.append(teryt)
+
+  if (jobs > 1):
+    print(f"Processing {len(woj_teryts)} voivodeships using {jobs} processes...")
+    # Start with the biggest voivodeships so that they don't end up running alone at the end
+    woj_teryts = sorted(woj_teryts, key=lambda teryt: path.getsize(f"data_in/addresses/{teryt}.zip"), reverse=True)
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker) as executor:
+      futures = [executor.submit(process_voivodeship, teryt, None, batch_size) for teryt in woj_teryts]
+      for future in as_completed(futures):
+        teryt = future.result()
+        manifest[teryt] = woj_inputs[teryt]
+        save_manifest(manifest_path, manifest)
+        print(f"Processed voivodeship {teryt}!")
+  else:
+    for teryt in woj_teryts:
+      process_voivodeship(teryt, utils, batch_size)
+      manifest[teryt] = woj_inputs[teryt]
+      save_manifest(manifest_path, manifest)
+
+  towns_inputs = get_inputs(["data_in/addresses/prng.zip", *source_files])
+  if (is_up_to_date(manifest, "prng", towns_inputs, [f"{addresses_path}/prng.parquet"])):
+    print("Town names are up to date!")
+    return
 
   print("Processing town names...")
   towns = geo.read_file(f"data_in/addresses/prng.zip")
   towns = towns[[key for key in towns_columns]].rename(columns=towns_columns)
   towns = towns[towns["type"] != "część miasta"]
   towns["teryt"] = towns["teryt"].str[0:6]
-  save_zip(f"{addresses_path}/prng", towns)
+  save_parquet(f"{addresses_path}/prng", towns)
+  manifest["prng"] = towns_inputs
+  save_manifest(manifest_path, manifest)
 
 if (__name__ == "__main__"):
-  process_data()
+  parser = argparse.ArgumentParser()
+  parser.add_argument("--jobs", type=int, default=1, help="Number of voivodeships processed in parallel")
+  parser.add_argument("--force", action="store_true", help="Rebuild all outputs even if their inputs haven't changed")
+  parser.add_argument("--batch-size", type=int, default=default_batch_size, help="Number of address points loaded at once")
+  args = parser.parse_args()
+  process_data(args.jobs, args.force, args.batch_size)
@@ -1,12 +1,39 @@
 from pandas import DataFrame
 import pandas
+import numpy as np
+import geopandas
+import shapely
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.compute as pc
 from geopandas import GeoDataFrame
 import os
+import hashlib
+import json
+import sqlite3
+import pickle
+import queue
+import threading
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import re, regex
 from regex import Match
-from const import first_name_letter_regex, holy_name_regex, prince_queen_regex, char_order, ordinal_regex, year_regex, quotation_regex, apostrophe_regex, dash_regex, building_types_regex
+from const import first_name_letter_regex, holy_name_regex, prince_queen_regex, char_order, ordinal_regex, year_regex, quotation_regex, apostrophe_regex, dash_regex, building_types_regex, building_num_regex, building_letter_regex
 import typing
-from typing import Dict
+from typing import Any, Callable, Dict, FrozenSet, Iterator, List, Tuple, TypedDict, TypeVar
+
+holy_name_pattern = re.compile(holy_name_regex, flags=re.IGNORECASE)
+prince_queen_pattern = re.compile(prince_queen_regex, flags=re.IGNORECASE)
+first_name_letter_pattern = regex.compile(first_name_letter_regex)
+ordinal_pattern = re.compile(ordinal_regex)
+year_pattern = re.compile(year_regex, flags=re.IGNORECASE)
+quotation_pattern = re.compile(quotation_regex)
+apostrophe_pattern = re.compile(apostrophe_regex)
+dash_pattern = re.compile(dash_regex)
+building_types_pattern = re.compile(building_types_regex)
+capitalize_pattern = regex.compile(r"(\")?([\p{Lu}|\p{L}]+)(\")?")
+roman_number_pattern = re.compile(r"^[IVXLCDM]+$")
+whitespace_pattern = re.compile(r"\s+")
 
 def head(df: DataFrame, n: int = 5):
   print(df.head(n))
@@ -24,11 +51,11 @@ def handle_capitalize(match: Match[str]):
   return text
 
 def capitalize(x: str):
-  word = map(lambda part: regex.sub(r"(\")?([\p{Lu}|\p{L}]+)(\")?", handle_capitalize, part), x.split("-"))
+  word = map(lambda part: capitalize_pattern.sub(handle_capitalize, part), x.split("-"))
   return "-".join(list(word))
 
 def capitalize_every_word(x: str):
-  sentence = map(lambda word: capitalize(word) if word != "i" and word != "RP" and word != "PCK" and not re.match(r"^[IVXLCDM]+$", word) else word, re.split(r"\s+", x))
+  sentence = map(lambda word: capitalize(word) if word != "i" and word != "RP" and word != "PCK" and not roman_number_pattern.match(word) else word, whitespace_pattern.split(x))
   return " ".join(list(sentence))
 
 def load_replacements():
@@ -45,6 +72,9 @@ def get_replacement_values(replacements: Dict[str, str]):
 def load_replacements_exceptions():
   return pandas.read_csv("const/replacements_exceptions.csv", sep=";", converters={ "teryt": str })
 
+def get_replacements_exceptions_by_teryt(exceptions: DataFrame) -> Dict[str, FrozenSet[str]]:
+  return { teryt: frozenset(streets) for teryt, streets in exceptions.groupby("teryt")["street"] }
+
 def load_street_prefixes():
   with open("const/street_prefixes.csv") as prefixes_file:
     lines = [line.strip().split(";") for line in prefixes_file.readlines()]
@@ -81,41 +111,261 @@ def load_names_exceptions():
 
   return f"({"|".join(regexes)})$"
 
+# Files read by Utils, rules in the latter ones only apply to a single TERYT
+global_rule_files = ["const/names.csv", "const/names_exceptions.txt", "const/street_replacements.csv", "const/street_prefixes.csv"]
+teryt_rule_files = ["const/replacements_exceptions.csv", "const/town_replacements.csv"]
+rule_files = [*global_rule_files, *teryt_rule_files]
+# Has to be changed whenever street and town names are normalized differently, cached names are reused otherwise
+normalizer_version = "1"
+
+def hash_file(path: str):
+  digest = hashlib.sha256()
+  with open(path, "rb") as file:
+    for chunk in iter(lambda: file.read(1024 * 1024), b""):
+      digest.update(chunk)
+  return digest.hexdigest()
+
+def hash_teryt_rows(path: str, teryt: str):
+  with open(path, encoding="utf-8") as file:
+    rows = [line.strip() for line in file.readlines() if line.startswith(teryt)]
+  return hashlib.sha256("\n".join(rows).encode()).hexdigest()
+
+def get_inputs(files: List[str]):
+  return { file: hash_file(file) for file in files }
+
+def is_up_to_date(manifest: Dict[str, Dict[str, str]], artifact: str, inputs: Dict[str, str], outputs: List[str]):
+  return manifest.get(artifact) == inputs and all([os.path.exists(output) for output in outputs])
+
+def load_manifest(path: str) -> Dict[str, Dict[str, str]]:
+  if (not os.path.isfile(path)):
+    return {}
+  with open(path, encoding="utf-8") as file:
+    return json.load(file)
+
+def save_manifest(path: str, manifest: Dict[str, Dict[str, str]]):
+  with open(f"{path}.tmp", "w", encoding="utf-8") as file:
+    json.dump(manifest, file, indent=2, sort_keys=True)
+  os.replace(f"{path}.tmp", path)
+
+def hash_files(files: List[str]):
+  digest = hashlib.sha256()
+  for file in files:
+    digest.update(file.encode())
+    digest.update(hash_file(file).encode())
+  return digest.hexdigest()
+
+def get_rules_hash():
+  return f"{normalizer_version}:{hash_files(rule_files)}"
+
+street_cache_teryts = 16
+
+class StreetNameCache:
+  def __init__(self, path: str, rules_hash: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    self.rules_hash = rules_hash
+    self.connection = sqlite3.connect(path, timeout=60)
+    self.connection.execute("CREATE TABLE IF NOT EXISTS street_names (rules TEXT, teryt TEXT, street TEXT, result TEXT, PRIMARY KEY (rules, teryt, street))")
+    # Results computed with different rules are no longer valid
+    self.connection.execute("DELETE FROM street_names WHERE rules != ?", (rules_hash,))
+    self.connection.commit()
+    # Results are loaded for a single TERYT on first use, only the recently used ones are kept in memory
+    self.results: OrderedDict[str, Dict[str, str]] = OrderedDict()
+    self.pending: list[tuple[str, str, str, str]] = []
+    self.hits = 0
+    self.misses = 0
+
+  def get_teryt_results(self, teryt: str):
+    if (teryt in self.results):
+      self.results.move_to_end(teryt)
+      return self.results[teryt]
+    # Results which weren't saved yet would be missing from the loaded ones
+    self.flush()
+    rows = self.connection.execute("SELECT street, result FROM street_names WHERE rules = ? AND teryt = ?", (self.rules_hash, teryt))
+    self.results[teryt] = { street: result for (street, result) in rows }
+    if (len(self.results) > street_cache_teryts):
+      self.results.popitem(last=False)
+    return self.results[teryt]
+
+  def get(self, teryt: str, street: str):
+    result = self.get_teryt_results(teryt).get(street)
+    if (result is None):
+      self.misses += 1
+    else:
+      self.hits += 1
+    return result
+
+  def set(self, teryt: str, street: str, result: str):
+    self.get_teryt_results(teryt)[street] = result
+    self.pending.append((self.rules_hash, teryt, street, result))
+    if (len(self.pending) >= 1000):
+      self.flush()
+
+  def flush(self):
+    if (len(self.pending) == 0):
+      return
+    self.connection.executemany("INSERT OR REPLACE INTO street_names VALUES (?, ?, ?, ?)", self.pending)
+    self.connection.commit()
+    self.pending = []
+
+  def print_stats(self):
+    total = self.hits + self.misses
+    hit_rate = self.hits * 100 / total if total > 0 else 0
+    print(f"Street name cache: {self.hits} hits, {self.misses} misses ({hit_rate:.1f}% hit rate).")
+
+class BordersCache:
+  def __init__(self, path: str, code_hash: str):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    self.code_hash = code_hash
+    self.connection = sqlite3.connect(path, timeout=60)
+    self.connection.execute("CREATE TABLE IF NOT EXISTS parsed_borders (code TEXT, key TEXT, tokens TEXT, PRIMARY KEY (code, key))")
+    # Tokens parsed by a different version of the tokenizer are no longer valid
+    self.connection.execute("DELETE FROM parsed_borders WHERE code != ?", (code_hash,))
+    self.connection.commit()
+    self.pending: list[tuple[str, str, str]] = []
+    self.hits = 0
+    self.misses = 0
+
+  def get(self, key: str):
+    row = self.connection.execute("SELECT tokens FROM parsed_borders WHERE code = ? AND key = ?", (self.code_hash, key)).fetchone()
+    if (row is None):
+      self.misses += 1
+      return None
+    self.hits += 1
+    return json.loads(row[0])
+
+  def set(self, key: str, tokens: list):
+    self.pending.append((self.code_hash, key, json.dumps(tokens, ensure_ascii=False)))
+    if (len(self.pending) >= 100):
+      self.flush()
+
+  def flush(self):
+    if (len(self.pending) == 0):
+      return
+    self.connection.executemany("INSERT OR REPLACE INTO parsed_borders VALUES (?, ?, ?)", self.pending)
+    self.connection.commit()
+    self.pending = []
+
+  def print_stats(self):
+    total = self.hits + self.misses
+    hit_rate = self.hits * 100 / total if total > 0 else 0
+    print(f"Parsed borders cache: {self.hits} hits, {self.misses} misses ({hit_rate:.1f}% hit rate).")
+
+class Rules(TypedDict):
+  rules_hash: str
+  code_hash: str
+  names: List[str]
+  names_regex: str
+  names_pattern: re.Pattern[str]
+  names_exceptions: str
+  names_exceptions_pattern: re.Pattern[str]
+  replacements: Dict[str, str]
+  replacement_patterns: List[Tuple[re.Pattern[str], str]]
+  replacements_values: List[str]
+  replacement_value_patterns: List[re.Pattern[str]]
+  replacements_exceptions: DataFrame
+  replacements_exceptions_by_teryt: Dict[str, FrozenSet[str]]
+  street_prefixes: Dict[str, str]
+  prefix_patterns: List[Tuple[re.Pattern[str], str]]
+  street_types: List[str]
+  street_type_patterns: List[re.Pattern[str]]
+  duplicate_prefixes_regex: str
+  town_replacements: Dict[str, Dict[str, str]]
+
+def build_rules(rules_hash: str, code_hash: str) -> Rules:
+  names = load_names()
+  names_regex = "(" + "|".join(names) + ")"
+  names_regex = f"{names_regex}(\\s+([iI]\\s+)?{names_regex})?(\\s+|$)"
+  names_exceptions = load_names_exceptions()
+  replacements = load_replacements()
+  replacements_values = get_replacement_values(replacements)
+  street_prefixes = load_street_prefixes()
+  street_types = get_street_types(street_prefixes)
+  prefixes_regex = "(" + "|".join(map(lambda street_type: street_type.strip(), street_types)) + ")"
+  replacements_exceptions = load_replacements_exceptions()
+
+  return {
+    "rules_hash": rules_hash,
+    "code_hash": code_hash,
+    "names": names,
+    "names_regex": names_regex,
+    "names_pattern": re.compile(names_regex),
+    "names_exceptions": names_exceptions,
+    "names_exceptions_pattern": re.compile(names_exceptions),
+    "replacements": replacements,
+    "replacement_patterns": [(re.compile(search, flags=re.IGNORECASE), replacements[search]) for search in replacements],
+    "replacements_values": replacements_values,
+    "replacement_value_patterns": [re.compile(value, flags=re.IGNORECASE) for value in replacements_values],
+    "replacements_exceptions": replacements_exceptions,
+    "replacements_exceptions_by_teryt": get_replacements_exceptions_by_teryt(replacements_exceptions),
+    "street_prefixes": street_prefixes,
+    "prefix_patterns": [(re.compile(search, flags=re.IGNORECASE), street_prefixes[search]) for search in street_prefixes],
+    "street_types": street_types,
+    "street_type_patterns": [re.compile(street_type, flags=re.IGNORECASE) for street_type in street_types],
+    "duplicate_prefixes_regex": f"{prefixes_regex}\\s+\\1",
+    "town_replacements": load_town_replacements(),
+  }
+
+def load_rules(bundle_path: str | None = None) -> Rules:
+  rules_hash = get_rules_hash()
+  # Compiled rules are built by this file, so the bundle is rebuilt whenever it changes, not only with normalizer_version
+  code_hash = hash_file(__file__)
+  if (bundle_path is not None and os.path.isfile(bundle_path)):
+    with open(bundle_path, "rb") as bundle_file:
+      rules: Rules = pickle.load(bundle_file)
+    if (rules["rules_hash"] == rules_hash and rules.get("code_hash") == code_hash):
+      return rules
+
+  rules = build_rules(rules_hash, code_hash)
+  if (bundle_path is not None):
+    os.makedirs(os.path.dirname(bundle_path), exist_ok=True)
+    tmp_path = f"{bundle_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as bundle_file:
+      pickle.dump(rules, bundle_file)
+    os.replace(tmp_path, bundle_path)
+  return rules
+
+rules_bundle_path = "cache/rules.pickle"
+no_replacements_exceptions: FrozenSet[str] = frozenset()
+
 class Utils:
-  def __init__(self):
-    names = load_names()
-    self.names = names
-    names_regex = "(" + "|".join(names) + ")"
-    names_regex = f"{names_regex}(\\s+([iI]\\s+)?{names_regex})?(\\s+|$)"
-    self.names_regex = names_regex
-    self.names_exceptions = load_names_exceptions()
-    self.replacements = load_replacements()
-    self.replacements_values = get_replacement_values(self.replacements)
-    self.replacements_exceptions = load_replacements_exceptions()
-    self.street_prefixes = load_street_prefixes()
-    self.street_types = get_street_types(self.street_prefixes)
-    prefixes_regex = "(" + "|".join(map(lambda street_type: street_type.strip(), self.street_types)) + ")"
-    duplicate_prefixes_regex = f"{prefixes_regex}\\s+\\1"
-    self.duplicate_prefixes_regex = duplicate_prefixes_regex
-    self.town_replacements = load_town_replacements()
+  def __init__(self, street_cache_path: str | None = None, bundle_path: str | None = rules_bundle_path):
+    rules = load_rules(bundle_path)
+    self.names = rules["names"]
+    self.names_regex = rules["names_regex"]
+    self.names_pattern = rules["names_pattern"]
+    self.names_exceptions = rules["names_exceptions"]
+    self.names_exceptions_pattern = rules["names_exceptions_pattern"]
+    self.replacements = rules["replacements"]
+    self.replacement_patterns = rules["replacement_patterns"]
+    self.replacements_values = rules["replacements_values"]
+    self.replacement_value_patterns = rules["replacement_value_patterns"]
+    self.replacements_exceptions = rules["replacements_exceptions"]
+    self.replacements_exceptions_by_teryt = rules["replacements_exceptions_by_teryt"]
+    self.street_prefixes = rules["street_prefixes"]
+    self.prefix_patterns = rules["prefix_patterns"]
+    self.street_types = rules["street_types"]
+    self.street_type_patterns = rules["street_type_patterns"]
+    self.duplicate_prefixes_regex = rules["duplicate_prefixes_regex"]
+    self.town_replacements = rules["town_replacements"]
+    self.street_cache = StreetNameCache(street_cache_path, rules["rules_hash"]) if street_cache_path is not None else None
 
   def remove_first_name(self, street: str):
-    if (re.search(self.names_exceptions, street)):
+    if (self.names_exceptions_pattern.search(street)):
       return street
     
-    if (re.search(holy_name_regex, street, flags=re.IGNORECASE)):
+    if (holy_name_pattern.search(street)):
       return street
     
-    if (re.search(prince_queen_regex, street, flags=re.IGNORECASE)):
+    if (prince_queen_pattern.search(street)):
       return street
     
-    name_removed = re.sub(self.names_regex, "", street)
+    name_removed = self.names_pattern.sub("", street)
     if (len(name_removed.strip()) > 0):
       return name_removed
     return street
 
   def remove_first_letter(self, street: str):
-    match = regex.search(first_name_letter_regex, street)
+    match = first_name_letter_pattern.search(street)
     if (match):
       name_letter = match.group(3)
       return street.replace(name_letter, "", 1)
@@ -123,42 +373,52 @@ class Utils:
     return street
 
   def remove_replacements(self, street: str):
-    for replacement in self.replacements_values:
-      if (re.search(replacement, street, flags=re.IGNORECASE)):
-        street = re.sub(replacement, "", street, flags=re.IGNORECASE)
+    for replacement in self.replacement_value_patterns:
+      if (replacement.search(street)):
+        street = replacement.sub("", street)
 
     return street.strip()
   
   def remove_street_type(self, street: str):
-    for street_type in self.street_types:
-      if (re.match(street_type, street, flags=re.IGNORECASE)):
-        street = re.sub(street_type, "", street, flags=re.IGNORECASE)
+    for street_type in self.street_type_patterns:
+      if (street_type.match(street)):
+        street = street_type.sub("", street)
         break
 
     return street.strip()
 
   def transform_street_name(self, street: str, teryt: str):
-    for search in self.street_prefixes:
-      street = re.sub(search, self.street_prefixes[search], street, flags=re.IGNORECASE)
-    replacements_exceptions = self.replacements_exceptions[self.replacements_exceptions["teryt"] == teryt]
-    if (street not in replacements_exceptions["street"].to_list()):
-      for search in self.replacements:
-        street = re.sub(search, self.replacements[search], street, flags=re.IGNORECASE)
-    street = re.sub(r"\s+", " ", street.strip()).replace(":", "")
-    if (street not in replacements_exceptions["street"].to_list()):
+    if (self.street_cache is None):
+      return self.normalize_street_name(street, teryt)
+
+    result = self.street_cache.get(teryt, street)
+    if (result is None):
+      result = self.normalize_street_name(street, teryt)
+      self.street_cache.set(teryt, street, result)
+    return result
+
+  def normalize_street_name(self, street: str, teryt: str):
+    for search, replacement in self.prefix_patterns:
+      street = search.sub(replacement, street)
+    replacements_exceptions = self.replacements_exceptions_by_teryt.get(teryt, no_replacements_exceptions)
+    if (street not in replacements_exceptions):
+      for search, replacement in self.replacement_patterns:
+        street = search.sub(replacement, street)
+    street = whitespace_pattern.sub(" ", street.strip()).replace(":", "")
+    if (street not in replacements_exceptions):
       street = self.remove_first_name(street)
     street = self.remove_first_letter(street)
-    street = re.sub(ordinal_regex, "", street)
-    street = re.sub(year_regex, r"\1 roku", street, flags=re.IGNORECASE)
-    street = re.sub(quotation_regex, r'"\2"', street)
-    street = re.sub(apostrophe_regex, "'", street)
-    street = re.sub(dash_regex, "-", street)
-    street = re.sub(building_types_regex, "", street)
+    street = ordinal_pattern.sub("", street)
+    street = year_pattern.sub(r"\1 roku", street)
+    street = quotation_pattern.sub(r'"\2"', street)
+    street = apostrophe_pattern.sub("'", street)
+    street = dash_pattern.sub("-", street)
+    street = building_types_pattern.sub("", street)
     street = re.sub(r"-$", "", street)
     street = re.sub(r"\s*-\s*", "-", street)
     street = re.sub(r"-$", "", street)
     street = re.sub(r"\.$", "", street)
-    street = re.sub(ordinal_regex, "", street)
+    street = ordinal_pattern.sub("", street)
     street = capitalize_every_word(street)
 
     return street
@@ -177,6 +437,15 @@ class Utils:
     return replacement
 
 max_letters = 3
+char_codes = { char: i + 1 for i, char in enumerate(char_order) }
+# Maps unicode code point to its position in char_order (0 for padding and unknown characters)
+char_lookup = np.zeros(max(map(ord, char_order)) + 1, dtype=np.int64)
+for char in char_codes:
+  char_lookup[ord(char)] = char_codes[char]
+letter_weights = np.array([pow(10, (max_letters - i - 1) * 2) for i in range(max_letters)], dtype=np.int64)
+building_num_pattern = re.compile(building_num_regex)
+building_letter_pattern = re.compile(building_letter_regex)
+
 def get_building_order(building_n: int | str, building_l: str):
   try:
     number = int(building_n) * pow(10, max_letters * 2)
@@ -188,14 +457,299 @@ def get_building_order(building_n: int | str, building_l: str):
   for i in range(min(len(building_l), max_letters)):
     curr_pow = (max_letters - i - 1) * 2
     char = building_l[i:i+1]
-    char_ord = char_order.index(char) + 1
+    # Unknown characters are ordered like padding, the same as in get_building_orders
+    char_ord = char_codes.get(char, 0)
     number += (char_ord * pow(10, curr_pow))
   
   return number
 
-def save_zip(path: str, gdf: GeoDataFrame):
-  gdf.to_file(f"{path}.shz", driver="ESRI Shapefile")
-  os.rename(f"{path}.shz", f"{path}.zip")
+def get_building_orders(building_n: np.ndarray, building_l: pandas.Series) -> np.ndarray:
+  letters = building_l.str[:max_letters].to_numpy(dtype=f"<U{max_letters}")
+  code_points = letters.view(np.uint32).reshape(len(letters), max_letters)
+  code_points = np.where(code_points < len(char_lookup), code_points, 0)
+  numbers = np.where(building_n >= 0, building_n, 0).astype(np.int64) * pow(10, max_letters * 2)
+  return numbers + char_lookup[code_points] @ letter_weights
+
+def parse_building_numbers(buildings: pandas.Series):
+  numbers = buildings.str.extract(building_num_pattern)[1]
+  building_n = pandas.to_numeric(numbers, errors="coerce").fillna(-1).astype(np.int64)
+  building_l = buildings.str.extract(building_letter_pattern)[0].fillna("")
+  building_o = get_building_orders(building_n.to_numpy(), building_l)
+  # -1 for addresses without a building number, these never match odd or even tokens
+  building_p = building_n.where(building_n < 0, building_n % 2)
+  return building_n, building_l, building_o, building_p
+
+# Repetitive text columns are held as categories, numbers use the smallest type which fits them
+address_schema: Dict[str, str] = {
+  "teryt": "category",
+  "town": "category",
+  "street": "category",
+  "no_type": "category",
+  "no_repl": "category",
+  "no_rep_typ": "category",
+  "building": "category",
+  "building_n": "int32",
+  "building_l": "category",
+  "building_o": "uint64",
+  "building_p": "int8",
+  "address_id": "int64",
+}
+street_schema: Dict[str, str] = { column: address_schema[column] for column in ["teryt", "town", "street", "no_type", "no_repl", "no_rep_typ"] }
+matched_address_schema: Dict[str, str] = { **address_schema, "token": "category", "district": "category" }
+
+def apply_schema(df: DataFrame, schema: Dict[str, str], columns: list[str] | None = None, compact_strings: bool = True):
+  columns = columns if columns is not None else list(schema)
+  missing_columns = [column for column in columns if column not in df.columns]
+  if (len(missing_columns) > 0):
+    raise ValueError(f"Missing columns {", ".join(missing_columns)}!")
+
+  for column in columns:
+    dtype = schema[column]
+    values = df[column]
+    if (dtype == "category"):
+      if (not compact_strings):
+        continue
+      # Sorted categories keep the same order as strings when sorting
+      if (isinstance(values.dtype, pandas.CategoricalDtype)):
+        df[column] = values.cat.set_categories(sorted(values.cat.categories))
+      else:
+        df[column] = values.astype("category")
+      continue
+
+    numbers = values.to_numpy()
+    if (values.isna().any()):
+      raise ValueError(f"Column {column} has missing values and can't be stored as {dtype}!")
+    limits = np.iinfo(dtype)
+    if (len(numbers) > 0 and (numbers.min() < limits.min or numbers.max() > limits.max)):
+      raise ValueError(f"Values in column {column} don't fit in {dtype}!")
+    df[column] = values.astype(dtype)
+  return df
+
+def remove_categories(df: DataFrame):
+  # Categories depend on the table a frame was cut from, saved files only keep the values
+  for column in df.columns:
+    values = df[column]
+    if (isinstance(values.dtype, pandas.CategoricalDtype)):
+      df[column] = values.astype(values.cat.categories.dtype)
+  return df
+
+def save_parquet(path: str, gdf: GeoDataFrame):
+  gdf.to_parquet(f"{path}.parquet.tmp", index=False, compression="zstd")
+  os.replace(f"{path}.parquet.tmp", f"{path}.parquet")
+
+def get_geo_metadata(gdf: GeoDataFrame):
+  return {
+    "version": "1.0.0",
+    "primary_column": "geometry",
+    "columns": {
+      "geometry": {
+        "encoding": "WKB",
+        "geometry_types": [],
+        "crs": gdf.crs.to_json_dict() if gdf.crs is not None else None,
+      }
+    }
+  }
+
+class GeoParquetWriter:
+  def __init__(self, path: str):
+    self.path = path
+    self.writer: pq.ParquetWriter | None = None
+    self.schema: pa.Schema | None = None
+    self.rows = 0
+
+  def write(self, gdf: GeoDataFrame):
+    df = DataFrame(gdf)
+    df["geometry"] = gdf.geometry.to_wkb()
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    if (self.writer is None or self.schema is None):
+      # Columns which are empty in the first batch can still contain text in later ones
+      fields = [field.with_type(pa.string()) if pa.types.is_null(field.type) else field for field in table.schema]
+      metadata = { **(table.schema.metadata or {}), b"geo": json.dumps(get_geo_metadata(gdf)).encode() }
+      self.schema = pa.schema(fields, metadata=metadata)
+      self.writer = pq.ParquetWriter(f"{self.path}.parquet.tmp", self.schema, compression="zstd")
+    self.writer.write_table(table.cast(self.schema))
+    self.rows += len(table)
+
+  def close(self):
+    if (self.writer is None):
+      return
+    self.writer.close()
+    self.writer = None
+    os.replace(f"{self.path}.parquet.tmp", f"{self.path}.parquet")
+
+  def abort(self):
+    if (self.writer is not None):
+      self.writer.close()
+      self.writer = None
+    if (os.path.exists(f"{self.path}.parquet.tmp")):
+      os.remove(f"{self.path}.parquet.tmp")
+
+default_pending_outputs = 4
+
+class OutputWriter:
+  def __init__(self, max_pending: int = default_pending_outputs):
+    # Bounded, so that finished frames waiting for the disk don't pile up in memory
+    self.queue: queue.Queue[Tuple[str, Callable[[], Any]] | None] = queue.Queue(maxsize=max_pending)
+    self.errors: List[str] = []
+    self.thread = threading.Thread(target=self.run, daemon=True)
+    self.thread.start()
+
+  def run(self):
+    while True:
+      task = self.queue.get()
+      if (task is None):
+        return
+      name, write = task
+      # Outputs written after a failed one could depend on it, e.g. closing a partially written file
+      if (len(self.errors) > 0):
+        continue
+      try:
+        write()
+      except Exception as e:
+        self.errors.append(f"{name}: {e!r}")
+
+  def submit(self, name: str, write: Callable[..., Any], *args: Any):
+    if (len(self.errors) > 0):
+      raise RuntimeError(f"Unable to write {name}, writing {self.errors[0]} failed!")
+    if (not self.thread.is_alive()):
+      raise RuntimeError(f"Output writer is closed, unable to write {name}!")
+    self.queue.put((name, lambda: write(*args)))
+
+  def join(self):
+    if (self.thread.is_alive()):
+      self.queue.put(None)
+      self.thread.join()
+    for error in self.errors:
+      print(f"⚠️ Failed to write {error}")
+
+  def close(self):
+    self.join()
+    if (len(self.errors) > 0):
+      raise RuntimeError(f"Failed to write {len(self.errors)} outputs!")
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type: type[BaseException] | None, *args: Any):
+    # Write errors are only reported when leaving because of another exception, so that it isn't replaced
+    if (exc_type is not None):
+      self.join()
+    else:
+      self.close()
+
+K = TypeVar("K")
+V = TypeVar("V")
+
+def prefetch(keys: List[K], load: Callable[[K], V], lookahead: int = 1) -> Iterator[V]:
+  if (lookahead <= 0):
+    for key in keys:
+      yield load(key)
+    return
+
+  # Next items are loaded in a background thread, at most lookahead of them are kept besides the current one
+  executor = ThreadPoolExecutor(max_workers=1)
+  futures = deque([executor.submit(load, key) for key in keys[:lookahead]])
+  try:
+    for i in range(len(keys)):
+      result = futures.popleft().result()
+      if (i + lookahead < len(keys)):
+        futures.append(executor.submit(load, keys[i + lookahead]))
+      yield result
+  finally:
+    executor.shutdown(cancel_futures=True)
+
+def write_output(writer: OutputWriter | None, name: str, write: Callable[..., Any], *args: Any):
+  if (writer is None):
+    write(*args)
+  else:
+    writer.submit(name, write, *args)
+
+def save_geojson(path: str, gdf: GeoDataFrame):
+  gdf.to_file(path, driver="GeoJSON")
+
+def load_parquet(path: str, columns: list[str] | None = None) -> GeoDataFrame:
+  return geopandas.read_parquet(f"{path}.parquet", columns=columns, memory_map=True)
+
+def load_table(path: str, columns: list[str] | None = None) -> DataFrame:
+  # Reads a GeoParquet file as plain attributes, geometry is only decoded if it is requested explicitly
+  return pq.read_table(f"{path}.parquet", columns=columns, memory_map=True).to_pandas()
+
+def save_arrow(path: str, table: pa.Table):
+  # Uncompressed Arrow IPC files can be memory-mapped by many processes without copying
+  with pa.OSFile(f"{path}.arrow.tmp", "wb") as sink:
+    with pa.ipc.new_file(sink, table.schema) as writer:
+      writer.write_table(table)
+  os.replace(f"{path}.arrow.tmp", f"{path}.arrow")
+
+def save_arrow_shards(path: str, parquet_path: str, keys: list[str], columns: list[str] | None = None, column: str = "teryt"):
+  table = pq.read_table(f"{parquet_path}.parquet", columns=columns, memory_map=True)
+  # Stable sort keeps the order of rows inside every shard
+  table = table.take(pc.sort_indices(table, [(column, "ascending")]))
+  values = table[column].to_numpy(zero_copy_only=False)
+  for key in keys:
+    start = np.searchsorted(values, key, side="left")
+    end = np.searchsorted(values, key, side="right")
+    save_arrow(f"{path}_{key}", table.slice(start, end - start))
+  return table
+
+def read_arrow(path: str) -> pa.Table:
+  return pa.ipc.open_file(pa.memory_map(f"{path}.arrow")).read_all()
+
+def load_arrow(path: str, columns: list[str] | None = None) -> DataFrame:
+  table = read_arrow(path)
+  return table.select(columns if columns is not None else [name for name in table.column_names if name != "geometry"]).to_pandas()
+
+class Shards:
+  def __init__(self, df: DataFrame, column: str = "teryt"):
+    # Rows of every shard keep their order from the whole table
+    self.empty = df.iloc[0:0]
+    self.shards: Dict[str, DataFrame] = { key: shard for key, shard in df.groupby(column, sort=False, observed=True) }
+
+  def get(self, key: str) -> DataFrame:
+    return self.shards.get(key, self.empty)
+
+  def keys(self):
+    return self.shards.keys()
+
+  def __len__(self):
+    return sum(len(shard) for shard in self.shards.values())
+
+geometry_chunk_size = 100000
+
+class GeometryIndex:
+  def __init__(self, table: pa.Table, key: str = "address_id"):
+    # Addresses are points, so only their coordinates are kept and geometries are only created for the rows which are saved
+    geo_metadata = json.loads(table.schema.metadata[b"geo"])
+    self.key = key
+    self.crs = geo_metadata["columns"]["geometry"]["crs"]
+    ids = table[key].to_numpy()
+    order = np.argsort(ids, kind="stable")
+    self.ids = ids[order]
+    self.x = np.empty(len(ids), dtype=np.float64)
+    self.y = np.empty(len(ids), dtype=np.float64)
+    wkb = table["geometry"].take(order)
+    for start in range(0, len(wkb), geometry_chunk_size):
+      geometries = shapely.from_wkb(wkb.slice(start, geometry_chunk_size).to_numpy(zero_copy_only=False))
+      if (np.any(shapely.get_type_id(geometries) > 0)):
+        raise ValueError("Only point geometries can be indexed!")
+      self.x[start:start + len(geometries)] = shapely.get_x(geometries)
+      self.y[start:start + len(geometries)] = shapely.get_y(geometries)
+
+  def attach(self, df: DataFrame) -> GeoDataFrame:
+    positions = np.searchsorted(self.ids, df[self.key].to_numpy())
+    x = self.x[positions]
+    # Missing geometries are stored as NaN coordinates
+    geometry = np.where(np.isnan(x), None, shapely.points(x, self.y[positions]))
+    return GeoDataFrame(df, geometry=geopandas.GeoSeries(geometry, crs=self.crs, index=df.index))
+
+def load_geometry_index(path: str, key: str = "address_id") -> GeometryIndex:
+  return GeometryIndex(pq.read_table(f"{path}.parquet", columns=[key, "geometry"], memory_map=True), key)
+
+def get_unique_rows(df: DataFrame, columns: list[str]):
+  codes = df.groupby(columns, dropna=False, sort=False).ngroup().to_numpy()
+  _, first_rows = np.unique(codes, return_index=True)
+  unique = df[columns].iloc[first_rows].reset_index(drop=True)
+  return unique, codes
 
 def concat(df1: GeoDataFrame | None, df2: pandas.DataFrame | GeoDataFrame):
   if (df1 is None):